@@ -3,6 +3,7 @@ from pydantic import BaseModel
 from fastapi.responses import JSONResponse
 from image_processor.core.views import router as health_router
 from image_processor.media.views import router as media_router
+from image_processor.tasks.views import router as tasks_router
 
 
 class ErrorResponse(BaseModel):
@@ -22,3 +23,4 @@ api_router = APIRouter(
 
 api_router.include_router(health_router)
 api_router.include_router(media_router)
+api_router.include_router(tasks_router)
@@ -1,13 +1,15 @@
 import asyncio
+import contextlib
 import json
 import logging
 from typing import Callable, Awaitable
 
 import aio_pika
-from aio_pika.abc import AbstractRobustChannel
+from aio_pika.abc import AbstractIncomingMessage, AbstractRobustChannel
 
 from image_processor.config import get_settings
-from image_processor.media.schema import CreateMediaSchema
+from image_processor.errors.exceptions import InvalidMessageError
+from image_processor.media.schema import CreateMediaSchema, RenderBatchSchema
 
 
 class Broker:
@@ -20,6 +22,31 @@ class Broker:
         self._host = get_settings().RABBITMQ_HOST
         self._port = get_settings().RABBITMQ_PORT
         self._queue_name = get_settings().RABBITMQ_QUEUE_NAME
+        # cheaper jobs are published with higher priority, see media/cost.py;
+        # RabbitMQ cannot change the arguments of an existing queue, so
+        # priority queues get their own names and the old ones are drained
+        max_priority = get_settings().QUEUE_MAX_PRIORITY
+        self._jobs_queue_name = self._priority_name(self._queue_name)
+        # sub-tasks of fanned out jobs, preview jobs and finished-job events
+        self._parts_queue_name = self._priority_name(f"{self._queue_name}.parts")
+        self._preview_queue_name = f"{self._queue_name}.preview"
+        self._events_queue_name = f"{self._queue_name}.events"
+        # fanout to every worker, e.g. to cancel a task wherever it runs
+        self._control_exchange_name = f"{self._queue_name}.control"
+        self._control_exchange = None
+        # failed messages wait in delay queues with growing TTLs, then return
+        # to their queue; after the last retry they are parked in <queue>.dead
+        self._retry_exchanges = []
+        self._dead_queue_name = f"{self._queue_name}.dead"
+        self._parts_queue = None
+        self._preview_queue = None
+        # old name -> new name of queues left over from before priorities
+        self._legacy_queue_names = {
+            name: self._priority_name(name)
+            for name in (self._queue_name, f"{self._queue_name}.parts")
+            if max_priority
+        }
+        self._legacy_queues = {}
         self._durable = True
         self._connection = None
         self._channel: AbstractRobustChannel | None = None
@@ -43,37 +70,282 @@ class Broker:
                     self._logger.error("Failed to connect to RabbitMQ")
                     raise
         self._channel = await self._connection.channel()
-        await self._channel.set_qos(prefetch_count=1)
+        await self._channel.set_qos(prefetch_count=get_settings().WORKER_PREFETCH)
+        max_priority = get_settings().QUEUE_MAX_PRIORITY
+        arguments = {"x-max-priority": max_priority} if max_priority else None
         self._queue = await self._channel.declare_queue(
-            self._queue_name, durable=self._durable
+            self._jobs_queue_name, durable=self._durable, arguments=arguments
+        )
+        self._parts_queue = await self._channel.declare_queue(
+            self._parts_queue_name, durable=self._durable, arguments=arguments
+        )
+        self._preview_queue = await self._channel.declare_queue(
+            self._preview_queue_name, durable=self._durable
+        )
+        await self._channel.declare_queue(self._events_queue_name, durable=self._durable)
+        self._control_exchange = await self._channel.declare_exchange(
+            self._control_exchange_name, aio_pika.ExchangeType.FANOUT, durable=self._durable
+        )
+        await self._declare_retries()
+        await self._find_legacy_queues()
+
+    @staticmethod
+    def _priority_name(name: str) -> str:
+        max_priority = get_settings().QUEUE_MAX_PRIORITY
+        return f"{name}.p{max_priority}" if max_priority else name
+
+    async def _find_legacy_queues(self):
+        """Look up queues of the names used before priorities, still to be consumed"""
+        self._legacy_queues = {}
+        for name in self._legacy_queue_names:
+            # a passive declare of a missing queue closes its channel
+            channel = await self._connection.channel()
+            try:
+                await channel.declare_queue(name, passive=True)
+            except aio_pika.exceptions.ChannelClosed:
+                continue
+            finally:
+                with contextlib.suppress(Exception):
+                    await channel.close()
+            self._legacy_queues[name] = await self._channel.declare_queue(
+                name, passive=True
+            )
+            self._logger.warning(
+                f"Draining {name}; delete it once empty, jobs now go to "
+                f"{self._legacy_queue_names[name]}"
+            )
+
+    async def _declare_retries(self):
+        self._retry_exchanges = []
+        for attempt in range(get_settings().RETRY_MAX_ATTEMPTS):
+            delay = get_settings().RETRY_BASE_DELAY * 2**attempt
+            name = f"{self._queue_name}.retry.{delay}s"
+            exchange = await self._channel.declare_exchange(
+                name, aio_pika.ExchangeType.FANOUT, durable=self._durable
+            )
+            # expired messages go back through the default exchange, keeping
+            # the routing key they were published with: their original queue
+            queue = await self._channel.declare_queue(
+                name,
+                durable=self._durable,
+                arguments={
+                    "x-message-ttl": delay * 1000,
+                    "x-dead-letter-exchange": "",
+                },
+            )
+            await queue.bind(exchange)
+            self._retry_exchanges.append(exchange)
+        await self._channel.declare_queue(self._dead_queue_name, durable=self._durable)
+
+    @property
+    def parts_queue_name(self) -> str:
+        return self._parts_queue_name
+
+    async def publish(
+        self, message: CreateMediaSchema, task_id: str, priority: int = 0
+    ):
+        # previews get their own consumer so they never wait behind full jobs
+        queue_name = (
+            self._preview_queue_name if message.preview else self._jobs_queue_name
+        )
+        await self._publish(
+            queue_name, message.model_dump(mode="json"), task_id, priority
+        )
+        self._logger.info(f"Published message {message.task_name} as {task_id} to {queue_name}")
+
+    async def publish_batch(self, batch: RenderBatchSchema, priority: int = 0):
+        await self._publish(
+            self._parts_queue_name, batch.model_dump(mode="json"), priority=priority
         )
 
-    async def publish(self, message: CreateMediaSchema):
+    async def publish_event(self, event: dict):
+        await self._publish(self._events_queue_name, event)
+
+    async def publish_control(self, message: dict):
+        if not self._connection:
+            await self.connect()
+        await self._control_exchange.publish(
+            aio_pika.Message(body=json.dumps(message).encode()), routing_key=""
+        )
+
+    async def _publish(
+        self,
+        routing_key: str,
+        body: dict,
+        message_id: str | None = None,
+        priority: int = 0,
+    ):
         if not self._connection:
             await self.connect()
         await self._channel.default_exchange.publish(
-            aio_pika.Message(body=json.dumps(message.model_dump(mode="json")).encode()),
-            routing_key=self._queue_name,
+            aio_pika.Message(
+                body=json.dumps(body).encode(),
+                message_id=message_id,
+                priority=priority,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ),
+            routing_key=routing_key,
         )
-        self._logger.info(f"Published message {message.task_name}")
 
     async def close(self):
         if self._connection and not self._connection.is_closed:
             await self._connection.close()
 
-    async def consume(self, callback: Callable[[CreateMediaSchema], Awaitable[None]]):
-        self._logger.info(f"Consuming {self._queue_name}")
+    async def consume(
+        self,
+        callback: Callable[[CreateMediaSchema, str | None, bool], Awaitable[None]],
+        batch_callback: Callable[[RenderBatchSchema, bool], Awaitable[None]],
+        stop: asyncio.Event | None = None,
+        control_callback: Callable[[dict], None] | None = None,
+    ):
+        """Handle up to prefetch_count messages per queue concurrently until stop is set.
+
+        Callbacks get whether this is the message's last attempt; if they raise,
+        the message is retried with backoff and finally dead-lettered.
+        """
+        self._logger.info(
+            f"Consuming {self._jobs_queue_name}, {self._parts_queue_name} and {self._preview_queue_name}"
+        )
+        if not self._connection:
+            await self.connect()
+
+        in_flight: set[asyncio.Task] = set()
+
+        def _parse(message: AbstractIncomingMessage, schema):
+            try:
+                return schema(**json.loads(message.body.decode("utf-8")))
+            except ValueError as e:
+                raise InvalidMessageError(f"Malformed message: {e}") from e
+
+        async def _on_task(message: AbstractIncomingMessage, last_attempt: bool):
+            payload = _parse(message, CreateMediaSchema)
+            await callback(payload, message.message_id, last_attempt)
+
+        async def _on_batch(message: AbstractIncomingMessage, last_attempt: bool):
+            await batch_callback(_parse(message, RenderBatchSchema), last_attempt)
+
+        def _handler(
+            handle: Callable[[AbstractIncomingMessage, bool], Awaitable[None]],
+        ):
+            async def _on_message(message: AbstractIncomingMessage):
+                task = asyncio.current_task()
+                in_flight.add(task)
+                retries = int((message.headers or {}).get("x-retries", 0))
+                try:
+                    self._logger.info("Received message")
+                    await handle(message, retries >= len(self._retry_exchanges))
+                    await message.ack()
+                except asyncio.CancelledError:
+                    # interrupted by shutdown, another worker takes it over;
+                    # on a closed channel the broker requeues it by itself
+                    with contextlib.suppress(Exception):
+                        await message.reject(requeue=True)
+                    raise
+                except InvalidMessageError as e:
+                    self._logger.error(f"Failed to process message: {e}")
+                    await self._retry(message, e, retries, dead_letter=True)
+                except Exception as e:
+                    self._logger.error(f"Failed to process message: {e}")
+                    await self._retry(message, e, retries)
+                finally:
+                    in_flight.discard(task)
+
+            return _on_message
+
+        control = None
+        if control_callback is not None:
+            control = await self.consume_control(control_callback)
+        consumers = [
+            (self._queue, await self._queue.consume(_handler(_on_task))),
+            (self._parts_queue, await self._parts_queue.consume(_handler(_on_batch))),
+            (self._preview_queue, await self._preview_queue.consume(_handler(_on_task))),
+        ]
+        for name, queue in self._legacy_queues.items():
+            on_message = _on_batch if name.endswith(".parts") else _on_task
+            consumers.append((queue, await queue.consume(_handler(on_message))))
+        try:
+            await (stop.wait() if stop else asyncio.Future())
+        finally:
+            # stop deliveries first, then let already received jobs finish;
+            # they can still be cancelled while draining
+            for queue, consumer_tag in consumers:
+                await queue.cancel(consumer_tag)
+            await self._drain(in_flight)
+            if control is not None:
+                await control[0].cancel(control[1])
+
+    async def consume_control(self, callback: Callable[[dict], None]):
+        """Receive messages broadcast to every process, returning (queue, consumer tag)"""
         if not self._connection:
             await self.connect()
 
-        async with self._queue.iterator() as queue_iter:
-            async for message in queue_iter:
-                async with message.process():
-                    try:
-                        self._logger.info("Received message")
-                        payload_dict = json.loads(message.body.decode("utf-8"))
-                        email_data = CreateMediaSchema(**payload_dict)
-                        await callback(email_data)
-                    except Exception as e:
-                        self._logger.error(f"Failed to process message: {e}")
-                        raise
+        async def _on_control(message: AbstractIncomingMessage):
+            try:
+                callback(json.loads(message.body.decode("utf-8")))
+            except Exception as e:
+                self._logger.error(f"Failed to handle control message: {e}")
+
+        # a private queue per process, gone when the process disconnects
+        queue = await self._channel.declare_queue(exclusive=True)
+        await queue.bind(self._control_exchange)
+        return queue, await queue.consume(_on_control, no_ack=True)
+
+    async def _retry(
+        self,
+        message: AbstractIncomingMessage,
+        error: Exception,
+        retries: int,
+        dead_letter: bool = False,
+    ):
+        """Republish a failed message to its next delay queue or the dead letter queue"""
+        headers = {
+            k: v for k, v in (message.headers or {}).items() if k != "x-death"
+        }
+        headers["x-error"] = str(error)[:1000]
+        if not dead_letter and retries < len(self._retry_exchanges):
+            headers["x-retries"] = retries + 1
+            exchange = self._retry_exchanges[retries]
+            # retries of messages from an old queue return to its replacement
+            routing_key = self._legacy_queue_names.get(
+                message.routing_key, message.routing_key
+            )
+            self._logger.warning(
+                f"Retrying message {message.message_id} in {exchange.name} ({retries + 1})"
+            )
+        else:
+            headers["x-source-queue"] = message.routing_key
+            exchange = self._channel.default_exchange
+            routing_key = self._dead_queue_name
+            self._logger.error(f"Moved message {message.message_id} to {routing_key}")
+        try:
+            await exchange.publish(
+                aio_pika.Message(
+                    body=message.body,
+                    headers=headers,
+                    message_id=message.message_id,
+                    priority=message.priority,
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                ),
+                routing_key=routing_key,
+            )
+        except Exception as e:
+            self._logger.error(f"Failed to republish message {message.message_id}: {e}")
+            with contextlib.suppress(Exception):
+                await message.reject(requeue=True)
+            return
+        # acknowledged only once the copy is queued, so nothing is lost
+        await message.ack()
+
+    async def _drain(self, in_flight: set[asyncio.Task]):
+        if not in_flight:
+            return
+        self._logger.info(f"Waiting for {len(in_flight)} running job(s) to finish")
+        _, pending = await asyncio.wait(
+            set(in_flight), timeout=get_settings().WORKER_DRAIN_TIMEOUT
+        )
+        for task in pending:
+            # cancelled jobs requeue their message for another worker
+            task.cancel()
+        if pending:
+            self._logger.warning(f"Requeued {len(pending)} unfinished job(s)")
+            await asyncio.gather(*pending, return_exceptions=True)
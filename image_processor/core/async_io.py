@@ -0,0 +1,41 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+T = TypeVar("T")
+
+# dedicated pool so slow disk I/O never starves the default executor used for DNS
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="file-io")
+
+
+async def run_io(func: Callable[..., T], *args: Any) -> T:
+    return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+class AsyncFile:
+    """File object whose blocking calls run on the I/O thread pool"""
+
+    def __init__(self, path: str, mode: str):
+        self._path = path
+        self._mode = mode
+        self._file = None
+
+    async def __aenter__(self) -> "AsyncFile":
+        self._file = await run_io(open, self._path, self._mode)
+        return self
+
+    async def __aexit__(self, *_):
+        await run_io(self._file.close)
+
+    async def read(self, size: int = -1) -> bytes:
+        return await run_io(self._file.read, size)
+
+    async def write(self, data: bytes) -> int:
+        return await run_io(self._file.write, data)
+
+    async def seek(self, offset: int) -> int:
+        return await run_io(self._file.seek, offset)
+
+
+def aopen(path: str, mode: str = "rb") -> AsyncFile:
+    return AsyncFile(path, mode)
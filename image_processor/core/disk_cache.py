@@ -0,0 +1,295 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from collections import Counter, OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Awaitable, Callable
+
+from image_processor.core.async_io import run_io
+
+# fill(tmp_path, previous_entry) writes the artifact to tmp_path and returns its
+# metadata, or returns None when previous_entry is still valid.
+FillCallback = Callable[[str, "CacheEntry | None"], Awaitable[dict | None]]
+
+
+@dataclass(eq=False)
+class CacheEntry:
+    key: str
+    path: str
+    size: int
+    created_at: float
+    validated_at: float
+    meta: dict = field(default_factory=dict)
+    refs: int = 0
+
+
+class DiskCache:
+    """On-disk LRU cache with a byte budget, reference counting and single-flight fills.
+
+    Pins and the index live in memory, so every process claims a slot-N
+    subdirectory of its own with an flock held while it runs; processes sharing
+    the volume never evict each other's files, and a restarted process takes
+    over a free slot with the entries in it. The byte budget is per slot.
+    """
+
+    LOCK_FILE = ".lock"
+
+    def __init__(
+        self,
+        name: str,
+        directory: str,
+        max_bytes: int,
+        logger: logging.Logger,
+        max_age: float = 0,
+        revalidate_after: float = 0,
+    ):
+        self._name = name
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._revalidate_after = revalidate_after
+        self._logger = logger
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._retired: list[CacheEntry] = []
+        self._pins: Counter[str] = Counter()
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._size = 0
+        self._stats = Counter(
+            hits=0, misses=0, revalidations=0, coalesced=0, evictions=0
+        )
+        self._directory, self._slot_lock = self._claim_slot(directory)
+        self._load()
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self._max_bytes,
+            "in_use": sum(1 for e in self._entries.values() if e.refs),
+            "slot": os.path.basename(self._directory),
+        }
+
+    async def acquire(
+        self, key: str, fill: FillCallback, suffix: str = "", revalidate: bool = False
+    ) -> CacheEntry:
+        """Return a pinned entry for key, filling it at most once across concurrent callers"""
+        self._pins[key] += 1
+        try:
+            task = self._inflight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(
+                    self._resolve(key, fill, suffix, revalidate)
+                )
+                self._inflight[key] = task
+                task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            else:
+                self._stats["coalesced"] += 1
+            entry = await asyncio.shield(task)
+            entry.refs += 1
+            return entry
+        finally:
+            self._pins[key] -= 1
+            if not self._pins[key]:
+                del self._pins[key]
+                if not task.done():
+                    # every caller gave up, e.g. its job was cancelled
+                    task.cancel()
+
+    @staticmethod
+    def read_meta(directory: str, key: str) -> dict | None:
+        """Metadata of the newest entry for key in any slot of directory, read from disk.
+
+        For processes that do not run the cache themselves; the file may be gone.
+        """
+        newest = None
+        try:
+            slots = [n for n in os.listdir(directory) if n.startswith("slot-")]
+        except OSError:
+            return None
+        for slot in slots:
+            try:
+                with open(os.path.join(directory, slot, f"{key}.json"), "r") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if newest is None or data["created_at"] > newest["created_at"]:
+                newest = data
+        return newest["meta"] if newest is not None else None
+
+    async def update_meta(self, entry: CacheEntry, **meta):
+        """Attach metadata derived from an entry's file, e.g. computed after a fill"""
+        entry.meta.update(meta)
+        if self._entries.get(entry.key) is entry:
+            await run_io(self._write_index, entry)
+
+    def release(self, entry: CacheEntry):
+        entry.refs = max(0, entry.refs - 1)
+        if entry.refs:
+            return
+        if entry in self._retired:
+            self._retired.remove(entry)
+            self._remove_file(entry.path)
+        else:
+            self._evict()
+
+    async def _resolve(
+        self, key: str, fill: FillCallback, suffix: str, revalidate: bool
+    ) -> CacheEntry:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and self._max_age and now - entry.created_at > self._max_age:
+            self._retire(entry)
+            entry = None
+
+        if entry is not None and (
+            not revalidate or now - entry.validated_at < self._revalidate_after
+        ):
+            self._stats["hits"] += 1
+            self._touch(entry)
+            return entry
+
+        tmp_path = os.path.join(self._directory, f".{uuid.uuid4().hex}.tmp")
+        try:
+            meta = await fill(tmp_path, entry)
+            if meta is None and entry is not None:
+                self._stats["revalidations"] += 1
+                self._stats["hits"] += 1
+                entry.validated_at = time.time()
+                await run_io(self._write_index, entry)
+                self._touch(entry)
+                return entry
+
+            self._stats["misses"] += 1
+            version = str(meta.get("sha256") or uuid.uuid4().hex)[:16]
+            path = os.path.join(self._directory, f"{key}-{version}{suffix}")
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        now = time.time()
+        new_entry = CacheEntry(
+            key=key,
+            path=path,
+            size=os.path.getsize(path),
+            created_at=now,
+            validated_at=now,
+            meta=meta,
+        )
+        if entry is not None:
+            self._retire(entry, keep_file=entry.path == path)
+        self._entries[key] = new_entry
+        self._size += new_entry.size
+        await run_io(self._write_index, new_entry)
+        self._evict()
+        return new_entry
+
+    def _touch(self, entry: CacheEntry):
+        self._entries.move_to_end(entry.key)
+        try:
+            os.utime(entry.path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        now = time.time()
+        # entries are kept in least-recently-used-first order
+        for entry in list(self._entries.values()):
+            over_budget = self._size > self._max_bytes
+            if not over_budget and not self._max_age:
+                break
+            expired = bool(self._max_age) and now - entry.created_at > self._max_age
+            if not (over_budget or expired) or entry.refs or self._pins[entry.key]:
+                continue
+            self._stats["evictions"] += 1
+            self._retire(entry)
+        if self._size > self._max_bytes:
+            self._logger.warning(
+                f"Cache {self._name} is over budget ({self._size}/{self._max_bytes} bytes),"
+                f" all remaining entries are in use"
+            )
+
+    def _retire(self, entry: CacheEntry, keep_file: bool = False):
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+            self._remove_file(self._index_path(entry.key))
+        self._size -= entry.size
+        if keep_file:
+            return
+        if entry.refs:
+            self._retired.append(entry)
+        else:
+            self._remove_file(entry.path)
+
+    def _index_path(self, key: str) -> str:
+        return os.path.join(self._directory, f"{key}.json")
+
+    def _write_index(self, entry: CacheEntry):
+        data = asdict(entry)
+        data.pop("refs")
+        tmp_path = f"{self._index_path(entry.key)}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self._index_path(entry.key))
+
+    @classmethod
+    def _claim_slot(cls, directory: str):
+        """Lock the lowest numbered slot no live process holds"""
+        slot = 0
+        while True:
+            path = os.path.join(directory, f"slot-{slot}")
+            os.makedirs(path, exist_ok=True)
+            lock = open(os.path.join(path, cls.LOCK_FILE), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                slot += 1
+                continue
+            return path, lock
+
+    def _load(self):
+        entries = []
+        known_paths = set()
+        for name in os.listdir(self._directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self._directory, name), "r") as f:
+                    entry = CacheEntry(**json.load(f))
+                entry.size = os.path.getsize(entry.path)
+                last_access = os.path.getmtime(entry.path)
+            except (OSError, ValueError, TypeError):
+                self._remove_file(os.path.join(self._directory, name))
+                continue
+            entries.append((last_access, entry))
+            known_paths.add(entry.path)
+
+        for _, entry in sorted(entries, key=lambda item: item[0]):
+            self._entries[entry.key] = entry
+            self._size += entry.size
+
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            # leftovers of this slot's previous owner, no other process writes here
+            if (
+                not name.endswith(".json")
+                and name != self.LOCK_FILE
+                and path not in known_paths
+            ):
+                self._remove_file(path)
+
+        self._logger.info(
+            f"Cache {self._name}: loaded {len(self._entries)} entries ({self._size} bytes)"
+        )
+        self._evict()
+
+    def _remove_file(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
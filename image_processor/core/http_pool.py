@@ -0,0 +1,93 @@
+import logging
+from collections import Counter
+
+import aiohttp
+
+from image_processor.config import get_settings
+
+
+class HttpPool:
+    """Process-wide keep-alive connection pools, one client session per upstream"""
+
+    def __init__(self, logger: logging.Logger):
+        self._logger = logger
+        self._sessions: dict[str, aiohttp.ClientSession] = {}
+        self._stats: dict[str, Counter] = {}
+
+    def session(self, name: str) -> aiohttp.ClientSession:
+        """Return the shared session for name, creating it on first use"""
+        session = self._sessions.get(name)
+        if session is None or session.closed:
+            session = self._create_session(name)
+            self._sessions[name] = session
+        return session
+
+    def stats(self) -> dict:
+        result = {}
+        for name, session in self._sessions.items():
+            connector = session.connector
+            result[name] = {
+                **self._stats[name],
+                "limit": connector.limit if connector else 0,
+                "limit_per_host": connector.limit_per_host if connector else 0,
+            }
+        return result
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+    def _create_session(self, name: str) -> aiohttp.ClientSession:
+        settings = get_settings()
+        connector = aiohttp.TCPConnector(
+            limit=settings.HTTP_POOL_LIMIT,
+            limit_per_host=settings.HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=settings.HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT,
+        )
+        # no total timeout: large downloads and upload chunks legitimately take
+        # long, a stalled socket is caught by sock_read instead
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=settings.HTTP_CONNECT_TIMEOUT,
+            sock_connect=settings.HTTP_CONNECT_TIMEOUT,
+            sock_read=settings.HTTP_READ_TIMEOUT,
+        )
+        self._stats.setdefault(name, Counter())
+        self._logger.debug(f"Creating HTTP pool {name}")
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            trace_configs=[self._trace_config(self._stats[name])],
+        )
+
+    @staticmethod
+    def _trace_config(stats: Counter) -> aiohttp.TraceConfig:
+        async def on_request_start(*_):
+            stats["requests"] += 1
+
+        async def on_request_exception(*_):
+            stats["errors"] += 1
+
+        async def on_connection_create_end(*_):
+            # a new TCP (and usually TLS) connection was opened
+            stats["connections_created"] += 1
+
+        async def on_connection_reuseconn(*_):
+            stats["connections_reused"] += 1
+
+        async def on_dns_cache_hit(*_):
+            stats["dns_cache_hits"] += 1
+
+        async def on_dns_cache_miss(*_):
+            stats["dns_cache_misses"] += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace_config
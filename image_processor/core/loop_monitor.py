@@ -0,0 +1,43 @@
+import asyncio
+import logging
+import time
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up a periodic timer"""
+
+    def __init__(self, logger: logging.Logger, interval: float = 0.5):
+        self._interval = interval
+        self._logger = logger
+        self._task: asyncio.Task | None = None
+        self._last = 0.0
+        self._max = 0.0
+        self._average = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "lag": round(self._last, 4),
+            "lag_avg": round(self._average, 4),
+            "lag_max": round(self._max, 4),
+        }
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self._interval)
+            lag = max(0.0, time.monotonic() - started - self._interval)
+            self._last = lag
+            self._max = max(self._max, lag)
+            self._average += 0.1 * (lag - self._average)
+            if lag > 1:
+                self._logger.warning(f"Event loop was blocked for {lag:.2f}s")
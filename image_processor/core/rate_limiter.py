@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+
+
+def parse_retry_after(value: str | None, default: float) -> float:
+    """Parse a Retry-After header given either in seconds or as an HTTP date"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limiter: halves the limit on throttling, grows it back on success"""
+
+    RATE_WINDOW = 60  # seconds
+
+    def __init__(
+        self,
+        name: str,
+        initial: int,
+        maximum: int,
+        logger: logging.Logger,
+        minimum: int = 1,
+    ):
+        self._name = name
+        self._minimum = max(1, minimum)
+        self._maximum = max(self._minimum, maximum)
+        self._limit = float(min(max(initial, self._minimum), self._maximum))
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._condition = asyncio.Condition()
+        self._completed: deque[float] = deque()
+        self._throttled = 0
+        self._logger = logger
+
+    def stats(self) -> dict:
+        self._trim_window()
+        return {
+            "limit": int(self._limit),
+            "in_flight": self._in_flight,
+            "throttled": self._throttled,
+            "paused_for": max(0.0, round(self._paused_until - time.monotonic(), 2)),
+            "requests_per_second": round(len(self._completed) / self.RATE_WINDOW, 3),
+        }
+
+    @asynccontextmanager
+    async def slot(self):
+        await self._acquire()
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def record_success(self):
+        # additive increase: +1 once a full window of `limit` calls succeeded
+        self._limit = min(self._maximum, self._limit + 1 / self._limit)
+        self._completed.append(time.monotonic())
+        self._trim_window()
+
+    def record_throttle(self, retry_after: float):
+        self._throttled += 1
+        self._limit = max(self._minimum, self._limit / 2)
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self._logger.warning(
+            f"{self._name} throttled, limit lowered to {int(self._limit)},"
+            f" pausing for {retry_after:.1f}s"
+        )
+
+    async def _acquire(self):
+        async with self._condition:
+            while True:
+                delay = self._paused_until - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), delay)
+                    except TimeoutError:
+                        pass
+                    continue
+                if self._in_flight < int(self._limit):
+                    self._in_flight += 1
+                    return
+                await self._condition.wait()
+
+    def _trim_window(self):
+        threshold = time.monotonic() - self.RATE_WINDOW
+        while self._completed and self._completed[0] < threshold:
+            self._completed.popleft()
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+
+class ValidationCache:
+    """Caches the result of a credential check and refreshes it in the background"""
+
+    # a failed check is retried soon so a fixed key is picked up quickly
+    NEGATIVE_TTL = 10  # seconds
+
+    def __init__(
+        self,
+        name: str,
+        check: Callable[[], Awaitable[bool]],
+        ttl: float,
+        refresh_ahead: float,
+        logger: logging.Logger,
+    ):
+        self._name = name
+        self._check = check
+        self._ttl = ttl
+        self._refresh_ahead = min(refresh_ahead, ttl)
+        self._logger = logger
+        self._valid: bool | None = None
+        self._checked_at = 0.0
+        self._refresh: asyncio.Task | None = None
+        # told about every invalidation found here, to pass it on to other processes
+        self.on_invalidate: Callable[[], None] | None = None
+
+    async def get(self) -> bool:
+        age = time.monotonic() - self._checked_at
+        if self._valid is None or age >= self._ttl_for(self._valid):
+            return await self._refresh_now()
+        if self._valid and age >= self._ttl - self._refresh_ahead:
+            self._start_refresh()
+        return self._valid
+
+    def invalidate(self, notify: bool = True):
+        """Drop the cached result, e.g. after a worker got 401 from the upstream"""
+        if self._valid is not None:
+            self._logger.warning(f"{self._name} credentials invalidated")
+        self._valid = None
+        if notify and self.on_invalidate is not None:
+            self.on_invalidate()
+
+    def _ttl_for(self, valid: bool) -> float:
+        return self._ttl if valid else self.NEGATIVE_TTL
+
+    async def _refresh_now(self) -> bool:
+        self._start_refresh()
+        return await asyncio.shield(self._refresh)
+
+    def _start_refresh(self):
+        # single flight: concurrent requests wait for the same upstream call
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._run_check())
+            self._refresh.add_done_callback(self._log_failure)
+
+    async def _run_check(self) -> bool:
+        valid = await self._check()
+        self._valid = valid
+        self._checked_at = time.monotonic()
+        return valid
+
+    def _log_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            self._logger.warning(
+                f"{self._name} credential check failed: {task.exception()!r}"
+            )
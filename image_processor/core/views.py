@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Request
 
 from image_processor.limiter import limiter
+from image_processor.service_provider import ServiceProvider
 
 router = APIRouter(prefix="", tags=["health"])
 
@@ -9,3 +10,8 @@ router = APIRouter(prefix="", tags=["health"])
 @limiter.limit("10/minute")
 async def root(request: Request):
     return {"status": "ok"}
+
+
+@router.get("/metrics", name="metrics")
+async def metrics():
+    return ServiceProvider.get_metrics()
@@ -10,7 +10,9 @@ from starlette.status import HTTP_422_UNPROCESSABLE_CONTENT
 
 
 async def http_error_handler(_: Request, exc: HTTPException) -> JSONResponse:
-    return JSONResponse({"errors": [exc.detail]}, status_code=exc.status_code)
+    return JSONResponse(
+        {"errors": [exc.detail]}, status_code=exc.status_code, headers=exc.headers
+    )
 
 
 async def http422_error_handler(
@@ -0,0 +1,14 @@
+class RetryableUploadError(Exception):
+    """Drive rejected a chunk with a transient status; the session can be resumed"""
+
+
+class UploadSessionExpiredError(Exception):
+    """Drive no longer knows the resumable session; the upload has to start over"""
+
+
+class InvalidMediaError(Exception):
+    """An asset can never be rendered, so retrying the job would not help"""
+
+
+class InvalidMessageError(Exception):
+    """A queue message that can never be processed, dead-lettered without retries"""
@@ -1,2 +1,7 @@
 GOOGLE_AUTH_ERROR = "Not authenticated. Check 'token.json' file. Try run auth flow using 'make auth' and try again."
+TOO_MANY_OUTPUTS_ERROR = "Payload produces {outputs} videos, the limit is {limit}. Set 'max_outputs' to render a random subset."
+BACKLOG_FULL_ERROR = "Render backlog is full, estimated wait is {eta} seconds. Retry in {retry_after} seconds."
+TASK_NOT_FOUND_ERROR = "Task {task_id} not found."
+IDEMPOTENCY_KEY_REUSED_ERROR = "Idempotency-Key was already used for task {task_id} with a different payload."
+TASK_NOT_CANCELLABLE_ERROR = "Task {task_id} is already {status}."
 ELEVENLAB_AUTH_ERROR = "Not authenticated. Check API KEY in .env file and try again."
@@ -0,0 +1,53 @@
+from image_processor.core.constants import CHUNK_SIZE
+
+
+class ChunkSizer:
+    """Picks resumable upload chunk sizes from measured throughput and round-trip time"""
+
+    # share of every chunk PUT spent transferring data rather than waiting a round-trip
+    TARGET_EFFICIENCY = 0.9
+    SMOOTHING = 0.3
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self._minimum = self._align(max(minimum, CHUNK_SIZE))
+        self._maximum = max(self._minimum, self._align(maximum))
+        self._size = min(max(self._align(initial), self._minimum), self._maximum)
+        self._throughput: float | None = None  # bytes per second
+        self._rtt: float | None = None  # seconds
+
+    def stats(self) -> dict:
+        return {
+            "chunk_size": self._size,
+            "throughput": round(self._throughput or 0),
+            "rtt": round(self._rtt or 0, 4),
+        }
+
+    def next_size(self) -> int:
+        return self._size
+
+    def record_rtt(self, seconds: float):
+        self._rtt = self._smooth(self._rtt, seconds)
+        self._update()
+
+    def record_chunk(self, size: int, seconds: float):
+        transfer = max(seconds - (self._rtt or 0), 1e-3)
+        self._throughput = self._smooth(self._throughput, size / transfer)
+        self._update()
+
+    def _update(self):
+        if not self._throughput or not self._rtt:
+            return
+        # a chunk costs rtt + size / throughput, so the target efficiency e needs
+        # size = throughput * rtt * e / (1 - e)
+        ratio = self.TARGET_EFFICIENCY / (1 - self.TARGET_EFFICIENCY)
+        size = self._align(int(self._throughput * self._rtt * ratio))
+        self._size = min(max(size, self._minimum), self._maximum)
+
+    def _smooth(self, current: float | None, sample: float) -> float:
+        if current is None:
+            return sample
+        return current + self.SMOOTHING * (sample - current)
+
+    @staticmethod
+    def _align(size: int) -> int:
+        return max(CHUNK_SIZE, size - size % CHUNK_SIZE)
@@ -1,59 +1,98 @@
-import json
+import asyncio
 import logging
+import os
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, TypeVar
 
 import aiohttp
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+
+from image_processor.config import get_settings
+from image_processor.core.async_io import aopen, run_io
+from image_processor.core.constants import CHUNK_SIZE, FILE_CHUNK_SIZE
+from image_processor.core.http_pool import HttpPool
+from image_processor.core.validation_cache import ValidationCache
+from image_processor.errors.exceptions import (
+    RetryableUploadError,
+    UploadSessionExpiredError,
+)
+from image_processor.google_clients.chunk_sizer import ChunkSizer
+from image_processor.google_clients.token_manager import TokenManager
+from image_processor.google_clients.upload_sessions import UploadSessionStore
+
+T = TypeVar("T")
 
 
 class GoogleDriveClient:
     """Google Drive client that provide uploading big files via resumable connection"""
 
     UPLOAD_API = "https://www.googleapis.com/upload/drive/v3"
+    RETRYABLE_ERRORS = (RetryableUploadError, aiohttp.ClientError, TimeoutError)
+    MAX_BACKOFF = 30  # seconds
 
-    def __init__(self, token_file: str, logger: logging.Logger):
-        self.__token_file = token_file
-        self.__creds: Credentials | None = None
+    def __init__(
+        self, token_file: str, logger: logging.Logger, http_pool: HttpPool
+    ):
+        self.__tokens = TokenManager(token_file, logger)
         self.__session: aiohttp.ClientSession | None = None
         self._logger = logger
+        self._http_pool = http_pool
+        self._validation = ValidationCache(
+            "Google Drive",
+            self.is_valid,
+            ttl=get_settings().VALIDATION_CACHE_TTL,
+            refresh_ahead=get_settings().VALIDATION_REFRESH_AHEAD,
+            logger=logger,
+        )
+        self._upload_slots = asyncio.Semaphore(get_settings().UPLOAD_CONCURRENCY)
+        self._active_uploads = 0
+        self._chunk_sizer = ChunkSizer(
+            FILE_CHUNK_SIZE, CHUNK_SIZE, get_settings().UPLOAD_MAX_CHUNK_SIZE
+        )
+        self._upload_sessions = UploadSessionStore(
+            get_settings().UPLOAD_SESSIONS_DIR, logger
+        )
 
-    async def shutdown(self):
-        if self.__session:
-            await self.__session.close()
+    @property
+    def validation(self) -> ValidationCache:
+        return self._validation
+
+    def upload_stats(self) -> dict:
+        return {"active_uploads": self._active_uploads, **self._chunk_sizer.stats()}
 
     async def setup(self):
         try:
-            with open(self.__token_file, "r") as f:
-                data = json.load(f)
-            self.__creds = Credentials.from_authorized_user_info(
-                data, scopes=["https://www.googleapis.com/auth/drive"]
-            )
-            if not self.__creds.valid:
-                self.__creds.refresh(Request())
-            self.__session = aiohttp.ClientSession(
-                headers={"Authorization": f"Bearer {self.__creds.token}"}
-            )
+            await self.__tokens.load()
+            self.__session = self._http_pool.session("google")
             return self
         except Exception as e:
             self._logger.error(f"Failed to setup Google Drive client: {e}")
             raise
 
     def is_ready(self) -> bool:
-        if self.__session is None:
-            self._refresh_token()
-        return self.__session is not None
+        return self.__session is not None and self.__tokens.ready
 
-    def _refresh_token(self):
-        if not self.__creds.valid or self.__creds.expired:
-            self.__creds.refresh(Request())
+    async def _auth_headers(self, headers: dict | None = None) -> dict:
+        """Attach a current access token; it is refreshed ahead of expiry off the loop"""
+        token = await self.__tokens.get_token()
+        return {**(headers or {}), "Authorization": f"Bearer {token}"}
+
+    async def is_authorized(self) -> bool:
+        """Cached is_valid, cheap enough for the request path"""
+        return await self._validation.get()
 
     async def is_valid(self) -> bool:
         if not self.is_ready():
             return False
         async with self.__session.get(
-            "https://www.googleapis.com/drive/v3/about?fields=user"
+            "https://www.googleapis.com/drive/v3/about?fields=user",
+            headers=await self._auth_headers(),
         ) as resp:
             if resp.status == 401:
+                self.__tokens.invalidate()
+                self._validation.invalidate()
                 return False
             return resp.status == 200
 
@@ -73,7 +112,7 @@ class GoogleDriveClient:
 
         async with self.__session.post(
             f"{self.UPLOAD_API}/files?uploadType=resumable",
-            headers=headers,
+            headers=await self._auth_headers(headers),
             json=metadata,
         ) as response:
             text = await response.text()
@@ -87,7 +126,8 @@ class GoogleDriveClient:
 
     async def upload_chunk(
         self, upload_url: str, chunk: bytes, start: int, end: int, total: int | str
-    ):
+    ) -> dict | None:
+        """Upload one chunk, returning the file resource once the upload is complete"""
         if not self.is_ready():
             raise Exception("Exception in set up")
         headers = {
@@ -95,6 +135,270 @@ class GoogleDriveClient:
             "Content-Range": f"bytes {start}-{end}/{total}",
         }
 
-        async with self.__session.put(upload_url, headers=headers, data=chunk) as resp:
-            if resp.status not in (200, 201, 308):
-                raise Exception(f"Upload failed: {await resp.text()}")
+        started = time.monotonic()
+        async with self.__session.put(
+            upload_url, headers=await self._auth_headers(headers), data=chunk
+        ) as resp:
+            await self._check_upload_response(resp)
+            self._chunk_sizer.record_chunk(len(chunk), time.monotonic() - started)
+            if resp.status == 308:
+                return None
+            return await resp.json()
+
+    async def query_upload_status(
+        self, upload_url: str, total: int | str = "*"
+    ) -> tuple[int, dict | None]:
+        """Return the number of bytes Drive acknowledged and the file once complete"""
+        if not self.is_ready():
+            raise Exception("Exception in set up")
+        headers = {"Content-Length": "0", "Content-Range": f"bytes */{total}"}
+
+        started = time.monotonic()
+        async with self.__session.put(
+            upload_url, headers=await self._auth_headers(headers)
+        ) as resp:
+            await self._check_upload_response(resp)
+            self._chunk_sizer.record_rtt(time.monotonic() - started)
+            if resp.status != 308:
+                return (total if isinstance(total, int) else 0), await resp.json()
+            # Range: bytes=0-<last acknowledged byte>, absent when nothing was stored
+            acknowledged = resp.headers.get("Range")
+            if not acknowledged:
+                return 0, None
+            return int(acknowledged.rsplit("-", 1)[1]) + 1, None
+
+    async def upload_files(
+        self, files: list[tuple[str, str]], mime_type: str = "video/mp4"
+    ) -> list[str | Exception]:
+        """Upload (path, filename) pairs concurrently, returning a file id or error per file"""
+        return await asyncio.gather(
+            *(self.upload_file(path, name, mime_type) for path, name in files),
+            return_exceptions=True,
+        )
+
+    async def upload_file(
+        self,
+        path: str,
+        filename: str,
+        mime_type: str = "video/mp4",
+        on_progress: Callable[[int], None] | None = None,
+        session_key: str | None = None,
+    ) -> str:
+        """Upload a local file through a persisted, resumable session and return its id.
+
+        With a session_key the session outlives the process: an upload of the same
+        file under the same key, even after a restart, continues where it stopped.
+        """
+        file_size = os.path.getsize(path)
+        resumable = session_key is not None
+        session_key = session_key or uuid.uuid4().hex
+        async with self._upload_slot():
+            try:
+                for _ in range(2):
+                    try:
+                        uploaded = await self._upload_file(
+                            path, filename, mime_type, file_size, session_key, on_progress
+                        )
+                        break
+                    except UploadSessionExpiredError:
+                        self._logger.warning(f"Upload session of {filename} expired")
+                        self._upload_sessions.remove(session_key)
+                else:
+                    raise Exception(f"Upload of {filename} could not be started")
+            except BaseException:
+                # a keyed session is resumed by the next attempt, or dropped by
+                # the caller through discard_upload; nobody knows other sessions
+                if not resumable:
+                    await self.discard_upload(session_key)
+                raise
+        self._upload_sessions.remove(session_key)
+
+        if uploaded is None:
+            raise Exception(f"Upload of {filename} was not finalized")
+        return uploaded["id"]
+
+    async def _upload_file(
+        self,
+        path: str,
+        filename: str,
+        mime_type: str,
+        file_size: int,
+        session_key: str,
+        on_progress: Callable[[int], None] | None,
+    ) -> dict | None:
+        upload_url = await run_io(self._upload_sessions.get, session_key, file_size)
+        if upload_url is None:
+            upload_url = await self.upload_file_in_stream(filename, mime_type)
+            await run_io(self._upload_sessions.save, session_key, upload_url, file_size)
+
+        offset, uploaded = await self._with_retries(
+            lambda: self.query_upload_status(upload_url, file_size)
+        )
+        if uploaded is not None:
+            return uploaded
+        if offset:
+            self._logger.info(f"Resuming upload of {filename} from byte {offset}")
+
+        async with aopen(path, "rb") as f:
+            await f.seek(offset)
+            while offset < file_size:
+                chunk = await f.read(self._chunk_sizer.next_size())
+                sent = offset
+                offset, uploaded = await self._send_chunk(
+                    upload_url, chunk, offset, file_size
+                )
+                if on_progress is not None:
+                    on_progress(offset - sent)
+        return uploaded
+
+    async def upload_stream(
+        self,
+        stream: asyncio.StreamReader,
+        filename: str,
+        mime_type: str = "video/mp4",
+        before_finalize: Callable[[], Awaitable[None]] | None = None,
+        on_progress: Callable[[int], None] | None = None,
+    ) -> str:
+        """Upload a stream of unknown length and return its Drive file id"""
+        async with self._upload_slot():
+            upload_url = await self.upload_file_in_stream(filename, mime_type)
+            try:
+                await self._with_retries(lambda: self.query_upload_status(upload_url))
+                offset = 0
+                size = self._chunk_sizer.next_size()
+                chunk = await self._read_exact_chunk(stream, size)
+                while len(chunk) == size:
+                    # read the next chunk while the current one is being sent
+                    size = self._chunk_sizer.next_size()
+                    next_read = asyncio.ensure_future(
+                        self._read_exact_chunk(stream, size)
+                    )
+                    try:
+                        offset, _ = await self._send_chunk(
+                            upload_url, chunk, offset, "*"
+                        )
+                    except BaseException:
+                        next_read.cancel()
+                        raise
+                    if on_progress is not None:
+                        on_progress(len(chunk))
+                    chunk = await next_read
+
+                # the total is only known now; make sure the producer succeeded
+                # before sending it, otherwise Drive would keep a truncated file
+                if before_finalize is not None:
+                    await before_finalize()
+                total = offset + len(chunk)
+                if chunk:
+                    _, uploaded = await self._send_chunk(upload_url, chunk, offset, total)
+                    if on_progress is not None:
+                        on_progress(len(chunk))
+                else:
+                    _, uploaded = await self._with_retries(
+                        lambda: self.query_upload_status(upload_url, total)
+                    )
+            except BaseException:
+                await self.cancel_upload(upload_url)
+                raise
+
+        if uploaded is None:
+            raise Exception(f"Upload of {filename} was not finalized")
+        return uploaded["id"]
+
+    async def discard_upload(self, session_key: str):
+        """Abort the persisted session of a file that will not be uploaded anymore"""
+        upload_url = await run_io(self._upload_sessions.get, session_key)
+        if upload_url is not None:
+            await self.cancel_upload(upload_url)
+            self._upload_sessions.remove(session_key)
+
+    async def cancel_upload(self, upload_url: str):
+        """Abort a resumable session so a partial upload never becomes a file"""
+        try:
+            async with self.__session.delete(
+                upload_url, headers=await self._auth_headers()
+            ) as resp:
+                self._logger.debug(f"Cancelled upload session: {resp.status}")
+        except aiohttp.ClientError as e:
+            self._logger.warning(f"Failed to cancel upload session: {e}")
+
+    async def _send_chunk(
+        self, upload_url: str, chunk: bytes, offset: int, total: int | str
+    ) -> tuple[int, dict | None]:
+        """Send chunk at offset, resuming from the acknowledged byte after a failure"""
+        attempt = 0
+        while True:
+            try:
+                uploaded = await self.upload_chunk(
+                    upload_url, chunk, offset, offset + len(chunk) - 1, total
+                )
+                return offset + len(chunk), uploaded
+            except self.RETRYABLE_ERRORS as e:
+                attempt += 1
+                if attempt > get_settings().UPLOAD_MAX_RETRIES:
+                    raise
+                await self._backoff(attempt, e)
+
+            acknowledged, uploaded = await self._with_retries(
+                lambda: self.query_upload_status(upload_url, total)
+            )
+            if uploaded is not None:
+                return acknowledged, uploaded
+            if not offset <= acknowledged <= offset + len(chunk):
+                raise Exception(
+                    f"Drive acknowledged byte {acknowledged} outside of the chunk at {offset}"
+                )
+            chunk = chunk[acknowledged - offset :]
+            offset = acknowledged
+            if not chunk:
+                return offset, None
+
+    async def _with_retries(self, request: Callable[[], Awaitable[T]]) -> T:
+        attempt = 0
+        while True:
+            try:
+                return await request()
+            except self.RETRYABLE_ERRORS as e:
+                attempt += 1
+                if attempt > get_settings().UPLOAD_MAX_RETRIES:
+                    raise
+                await self._backoff(attempt, e)
+
+    async def _backoff(self, attempt: int, error: Exception):
+        # full jitter keeps concurrent uploads from retrying in lockstep
+        delay = random.uniform(0, min(self.MAX_BACKOFF, 2 ** (attempt - 1)))
+        self._logger.warning(
+            f"Upload request failed ({error!r}), retry {attempt} in {delay:.1f}s"
+        )
+        await asyncio.sleep(delay)
+
+    async def _check_upload_response(self, resp: aiohttp.ClientResponse):
+        if resp.status in (200, 201, 308):
+            return
+        text = await resp.text()
+        if resp.status == 401:
+            # the token was revoked or expired early; retry with a fresh one
+            self.__tokens.invalidate()
+            self._validation.invalidate()
+            raise RetryableUploadError(f"Upload unauthorized: {text}")
+        if resp.status in (404, 410):
+            raise UploadSessionExpiredError(f"Upload session expired: {text}")
+        if resp.status in (408, 429) or resp.status >= 500:
+            raise RetryableUploadError(f"Upload failed {resp.status}: {text}")
+        raise Exception(f"Upload failed {resp.status}: {text}")
+
+    @asynccontextmanager
+    async def _upload_slot(self):
+        async with self._upload_slots:
+            self._active_uploads += 1
+            try:
+                yield
+            finally:
+                self._active_uploads -= 1
+
+    @staticmethod
+    async def _read_exact_chunk(stream: asyncio.StreamReader, size: int) -> bytes:
+        try:
+            return await stream.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            return e.partial
@@ -0,0 +1,56 @@
+import asyncio
+import datetime
+import json
+import logging
+
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+
+from image_processor.core.async_io import run_io
+
+
+class TokenManager:
+    """Keeps the Drive OAuth token fresh, refreshing it off the event loop"""
+
+    SCOPES = ["https://www.googleapis.com/auth/drive"]
+    REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+    def __init__(self, token_file: str, logger: logging.Logger):
+        self._token_file = token_file
+        self._creds: Credentials | None = None
+        self._lock = asyncio.Lock()
+        self._logger = logger
+
+    @property
+    def ready(self) -> bool:
+        return self._creds is not None
+
+    async def load(self):
+        data = json.loads(await run_io(self._read_token_file))
+        self._creds = Credentials.from_authorized_user_info(data, scopes=self.SCOPES)
+        await self.get_token()
+
+    async def get_token(self) -> str:
+        if self._needs_refresh():
+            async with self._lock:
+                if self._needs_refresh():
+                    # google-auth refreshes synchronously over `requests`
+                    await asyncio.to_thread(self._creds.refresh, Request())
+                    self._logger.debug("Google access token refreshed")
+        return self._creds.token
+
+    def invalidate(self):
+        """Force a refresh on next use, e.g. after Drive answered 401"""
+        if self._creds is not None:
+            self._creds.expiry = datetime.datetime.min
+
+    def _needs_refresh(self) -> bool:
+        if not self._creds.token or self._creds.expiry is None:
+            return not self._creds.valid
+        # google-auth keeps expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.UTC).replace(tzinfo=None)
+        return self._creds.expiry - now < self.REFRESH_MARGIN
+
+    def _read_token_file(self) -> str:
+        with open(self._token_file, "r") as f:
+            return f.read()
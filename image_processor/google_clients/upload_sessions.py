@@ -0,0 +1,50 @@
+import json
+import logging
+import os
+import time
+
+
+class UploadSessionStore:
+    """Persists resumable upload session URLs so a restarted worker can finish uploads.
+
+    Keys are chosen by the caller and must be usable as file names.
+    """
+
+    # Drive keeps resumable sessions for about a week
+    MAX_AGE = 6 * 24 * 60 * 60
+
+    def __init__(self, directory: str, logger: logging.Logger):
+        self._directory = directory
+        self._logger = logger
+        os.makedirs(self._directory, exist_ok=True)
+
+    def get(self, key: str, size: int | None = None) -> str | None:
+        """Return the session of key, unless it is too old or was for a file of another size"""
+        try:
+            with open(self._path(key), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - data.get("created_at", 0) > self.MAX_AGE:
+            self.remove(key)
+            return None
+        if size is not None and data.get("size") != size:
+            return None
+        return data.get("upload_url")
+
+    def save(self, key: str, upload_url: str, size: int | None = None):
+        tmp_path = f"{self._path(key)}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"upload_url": upload_url, "size": size, "created_at": time.time()}, f
+            )
+        os.replace(tmp_path, self._path(key))
+
+    def remove(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, f"{key}.json")
@@ -23,22 +23,35 @@ def get_application() -> FastAPI:
 
     @asynccontextmanager
     async def lifespan(app: FastAPI):
-        service_provider = ServiceProvider()
+        service_provider = ServiceProvider(worker=settings.EMBEDDED_WORKER)
         app.state.limiter = limiter
         app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
         app.state.service_provider = service_provider
+        service_provider.loop_monitor.start()
         await service_provider.google_drive_client.setup()
         await service_provider.rabbitmq_broker.connect()
 
-        task = asyncio.create_task(
-            service_provider.rabbitmq_broker.consume(
-                service_provider.media_service.process_task
+        # jobs are normally handled by `python -m image_processor.worker`
+        task = None
+        if not settings.EMBEDDED_WORKER:
+            # credential invalidations reported by the workers
+            await service_provider.rabbitmq_broker.consume_control(
+                service_provider.media_service.handle_control
+            )
+        else:
+            task = asyncio.create_task(
+                service_provider.rabbitmq_broker.consume(
+                    service_provider.media_service.process_task,
+                    service_provider.media_service.process_batch,
+                    control_callback=service_provider.media_service.handle_control,
+                )
             )
-        )
         try:
             yield
         finally:
-            task.cancel()
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
             await service_provider.shutdown()
 
     application = FastAPI(lifespan=lifespan)
@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import os
+
+import aiohttp
+
+from image_processor.core.async_io import aopen
+from image_processor.core.constants import FILE_CHUNK_SIZE
+from image_processor.core.disk_cache import CacheEntry, DiskCache
+from image_processor.errors.exceptions import InvalidMediaError
+from image_processor.media import probe
+
+
+class AssetCache:
+    """Download cache for remote media, keyed by URL and revalidated with conditional requests"""
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        revalidate_after: float,
+        logger: logging.Logger,
+    ):
+        self._cache = DiskCache(
+            "assets",
+            directory,
+            max_bytes,
+            logger,
+            revalidate_after=revalidate_after,
+        )
+        self._logger = logger
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+    async def acquire(self, session: aiohttp.ClientSession, url: str) -> CacheEntry:
+        """Return a pinned entry whose meta["media"] holds the probed stream summary"""
+        url = str(url)
+        key = hashlib.sha256(url.encode()).hexdigest()
+        ext = os.path.splitext(url)[1].split("?")[0] or ".mp4"
+
+        async def _fill(path: str, previous: CacheEntry | None) -> dict | None:
+            return await self._download(session, url, path, previous)
+
+        entry = await self._cache.acquire(key, _fill, suffix=ext, revalidate=True)
+        if "media" not in entry.meta:
+            # cached before the metadata index existed
+            try:
+                await self._cache.update_meta(entry, media=await self._probe(entry.path, url))
+            except BaseException:
+                self._cache.release(entry)
+                raise
+        return entry
+
+    def release(self, entry: CacheEntry):
+        self._cache.release(entry)
+
+    @staticmethod
+    def cached_duration(directory: str, url: str) -> float | None:
+        """Probed duration of an asset any worker downloaded into directory, blocking"""
+        meta = DiskCache.read_meta(directory, hashlib.sha256(str(url).encode()).hexdigest())
+        if meta is None or "media" not in meta:
+            return None
+        return meta["media"]["duration"] or None
+
+    async def _download(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        path: str,
+        previous: CacheEntry | None,
+    ) -> dict | None:
+        headers = {}
+        if previous is not None:
+            if previous.meta.get("etag"):
+                headers["If-None-Match"] = previous.meta["etag"]
+            if previous.meta.get("last_modified"):
+                headers["If-Modified-Since"] = previous.meta["last_modified"]
+
+        try:
+            async with session.get(url, headers=headers) as resp:
+                if resp.status == 304 and previous is not None:
+                    return None
+                if 400 <= resp.status < 500 and resp.status not in (408, 429):
+                    raise InvalidMediaError(f"Download failed {resp.status}: {url}")
+                if resp.status != 200:
+                    raise Exception(f"Download failed {resp.status}: {url}")
+                digest = hashlib.sha256()
+                async with aopen(path, "wb") as f:
+                    while True:
+                        chunk = await resp.content.read(FILE_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                        await f.write(chunk)
+                meta = {
+                    "url": url,
+                    "etag": resp.headers.get("ETag"),
+                    "last_modified": resp.headers.get("Last-Modified"),
+                    "sha256": digest.hexdigest(),
+                }
+        except (aiohttp.ClientError, TimeoutError) as e:
+            if previous is None:
+                raise
+            self._logger.warning(f"Revalidation of {url} failed, serving cached copy: {e}")
+            return None
+        # probed once per download; unreadable media never enters the cache
+        meta["media"] = await self._probe(path, url)
+        return meta
+
+    @staticmethod
+    async def _probe(path: str, url: str) -> dict:
+        try:
+            media = probe.summarize(await probe.probe(path))
+        except Exception as e:
+            raise InvalidMediaError(f"Unreadable media {url}: {e}")
+        if not media["has_video"] and not media["has_audio"]:
+            raise InvalidMediaError(f"Unreadable media {url}: no audio or video stream")
+        return media
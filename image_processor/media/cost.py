@@ -0,0 +1,30 @@
+import math
+
+from image_processor.config import get_settings
+from image_processor.media.schema import CreateMediaSchema
+
+# used for clips that were never downloaded, so their duration is unknown
+ASSUMED_CLIP_SECONDS = 5.0
+SPEECH_CHARS_PER_SECOND = 15
+
+
+def estimate_cost(payload: CreateMediaSchema, durations: dict[str, float]) -> float:
+    """Rough seconds of media a job makes the workers process"""
+    limit = get_settings().PREVIEW_CLIP_SECONDS if payload.preview else math.inf
+
+    def clip_seconds(url) -> float:
+        return min(durations.get(str(url), ASSUMED_CLIP_SECONDS), limit)
+
+    blocks = payload.ordered_video_blocks()
+    # every distinct clip is normalized once
+    normalize = sum(clip_seconds(url) for url in {str(u) for b in blocks for u in b})
+    # a part takes one clip of every block
+    part = sum(sum(clip_seconds(url) for url in block) / len(block) for block in blocks)
+    speech = sum(len(s.text) for s in payload.text_to_speech) / SPEECH_CHARS_PER_SECOND
+    return normalize + payload.output_count() * part + speech
+
+
+def priority(cost: float, max_priority: int) -> int:
+    """Shortest job first: one priority level less per doubling above a minute"""
+    level = max(0, math.ceil(math.log2(max(cost, 1) / 60)))
+    return max(0, max_priority - level)
@@ -1,57 +1,114 @@
+import hashlib
+import json
 import logging
-import os
-import uuid
-
-import aiohttp
 
 from image_processor.config import get_settings
+from image_processor.core.async_io import aopen
+from image_processor.core.disk_cache import CacheEntry, DiskCache
+from image_processor.core.http_pool import HttpPool
+from image_processor.core.rate_limiter import AdaptiveLimiter, parse_retry_after
 from image_processor.core.timer import timer
+from image_processor.core.validation_cache import ValidationCache
 
 
 class ElevenLabsClient:
-    def __init__(self, logger: logging.Logger):
+    MODEL_ID = "eleven_multilingual_v2"
+    VOICE_SETTINGS = {"stability": 0.5, "similarity_boost": 0.75}
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        speech_cache: DiskCache | None,
+        http_pool: HttpPool,
+    ):
         self._logger = logger
+        self._http_pool = http_pool
         self._mapped_name: dict[str, str] = {}
+        # None in the API process, which only checks the credentials
+        self._speech_cache = speech_cache
+        self._limiter = AdaptiveLimiter(
+            "ElevenLabs",
+            initial=get_settings().ELEVENLABS_CONCURRENCY,
+            maximum=get_settings().ELEVENLABS_MAX_CONCURRENCY,
+            logger=logger,
+        )
+        self._validation = ValidationCache(
+            "ElevenLabs",
+            self.is_valid,
+            ttl=get_settings().VALIDATION_CACHE_TTL,
+            refresh_ahead=get_settings().VALIDATION_REFRESH_AHEAD,
+            logger=logger,
+        )
+
+    @property
+    def validation(self) -> ValidationCache:
+        return self._validation
+
+    def cache_stats(self) -> dict:
+        return self._speech_cache.stats()
+
+    def limiter_stats(self) -> dict:
+        return self._limiter.stats()
 
     @timer
-    async def get_speech_by_text(
-        self, session: aiohttp.ClientSession, text: str, voice_name
-    ) -> str:
+    async def get_speech_by_text(self, text: str, voice_name) -> CacheEntry:
+        """Synthesize text, returning a pinned cache entry that must be released"""
         if not self._mapped_name:
             ok = await self._fetch_name_id_map()
             if not ok:
                 raise Exception("Error when fetching voice id")
 
         voice_id = self._get_speech_id_by_name(voice_name)
+        data = {
+            "text": text,
+            "model_id": self.MODEL_ID,
+            "voice_settings": self.VOICE_SETTINGS,
+        }
+        key = hashlib.sha256(
+            json.dumps({**data, "voice_id": voice_id}, sort_keys=True).encode()
+        ).hexdigest()
+
+        async def _fill(path: str, _: CacheEntry | None) -> dict:
+            await self._synthesize(voice_id, data, path)
+            return {"voice_id": voice_id, "model_id": self.MODEL_ID}
+
+        return await self._speech_cache.acquire(key, _fill, suffix=".mp3")
+
+    def release(self, entry: CacheEntry):
+        self._speech_cache.release(entry)
+
+    async def _synthesize(self, voice_id: str, data: dict, path: str):
         headers = {
             "xi-api-key": get_settings().ELEVENLABS_API_KEY,
             "Content-Type": "application/json",
         }
-        data = {
-            "text": text,
-            "model_id": "eleven_multilingual_v2",
-            "voice_settings": {"stability": 0.5, "similarity_boost": 0.75},
-        }
-        filename = f"/tmp/{uuid.uuid4()}.mp3"
-        try:
-            async with session.post(
-                f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}",
-                json=data,
-                headers=headers,
-                timeout=60,
-            ) as response:
-                if response.status != 200:
-                    self._logger.error(
-                        f"Failed on call to ElevenLabs API: {response.status} - {await response.text()}"
-                    )
-                    raise Exception("Failed on call to ElevenLabs API")
-                with open(filename, "wb") as f:
-                    f.write(await response.read())
-                return filename
-        except Exception as e:
-            if os.path.exists(filename):
-                os.remove(filename)
-            raise e
+        retries = get_settings().ELEVENLABS_MAX_RETRIES
+        for attempt in range(retries + 1):
+            async with self._limiter.slot():
+                async with self._http_pool.session("elevenlabs").post(
+                    f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}",
+                    json=data,
+                    headers=headers,
+                ) as response:
+                    if response.status == 429 and attempt < retries:
+                        self._limiter.record_throttle(
+                            parse_retry_after(
+                                response.headers.get("Retry-After"), 2**attempt
+                            )
+                        )
+                        continue
+                    if response.status == 401:
+                        self._validation.invalidate()
+                    if response.status != 200:
+                        self._logger.error(
+                            f"Failed on call to ElevenLabs API: {response.status} - {await response.text()}"
+                        )
+                        raise Exception("Failed on call to ElevenLabs API")
+                    content = await response.read()
+                    self._limiter.record_success()
+            async with aopen(path, "wb") as f:
+                await f.write(content)
+            return
 
     def _get_speech_id_by_name(self, name: str):
         """Get speech id by name or fallback"""
@@ -60,40 +117,45 @@ class ElevenLabsClient:
             self._logger.warning("Speech id by name not found")
         return speech_id or "JBFqnCBsd6RMkjVDRZzb"
 
-    async def _fetch_name_id_map(self):
-        if self._mapped_name:
-            return self._mapped_name
+    async def _fetch_name_id_map(self, refresh: bool = False):
+        if self._mapped_name and not refresh:
+            return True
         url = "https://api.elevenlabs.io/v1/voices"
 
         headers = {
             "xi-api-key": get_settings().ELEVENLABS_API_KEY,
             "Content-Type": "application/json",
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=headers) as response:
-                text = await response.text()
-                if response.status == 401:
-                    self._logger.warning(f"API KEY is invalid {text}")
-                    return False
-
-                if response.status != 200:
-                    self._logger.warning("Failed to fetch voice")
-                    return False
-
-                data = await response.json()
-                mapped_name = {}
-                for voice in data.get("voices", []):
-                    full_name = voice.get("name", "")
-                    voice_id = voice.get("voice_id", "")
-
-                    mapped_name[full_name] = voice_id
-                    short_name = full_name.split(" ")[0].split("-")[0].strip()
-                    if short_name not in mapped_name:
-                        mapped_name[short_name] = voice_id
-                self._mapped_name = mapped_name
-                return True
+        async with self._http_pool.session("elevenlabs").get(
+            url, headers=headers
+        ) as response:
+            text = await response.text()
+            if response.status == 401:
+                self._logger.warning(f"API KEY is invalid {text}")
+                self._validation.invalidate()
+                return False
 
-    async def is_valid(self) -> bool:
-        if self._mapped_name:
+            if response.status != 200:
+                self._logger.warning("Failed to fetch voice")
+                return False
+
+            data = await response.json()
+            mapped_name = {}
+            for voice in data.get("voices", []):
+                full_name = voice.get("name", "")
+                voice_id = voice.get("voice_id", "")
+
+                mapped_name[full_name] = voice_id
+                short_name = full_name.split(" ")[0].split("-")[0].strip()
+                if short_name not in mapped_name:
+                    mapped_name[short_name] = voice_id
+            self._mapped_name = mapped_name
             return True
-        return await self._fetch_name_id_map()
+
+    async def is_authorized(self) -> bool:
+        """Cached is_valid, cheap enough for the request path"""
+        return await self._validation.get()
+
+    async def is_valid(self) -> bool:
+        # always ask the API: this is what the validation cache refreshes with
+        return await self._fetch_name_id_map(refresh=True)
@@ -0,0 +1,87 @@
+import asyncio
+import json
+from fractions import Fraction
+
+
+async def probe(path: str) -> dict:
+    """Return ffprobe's format and stream information for a media file"""
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_format",
+        "-show_streams",
+        "-of",
+        "json",
+        path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    except BaseException:
+        process.kill()
+        raise
+    if process.returncode != 0:
+        raise Exception(f"ffprobe failed on {path}: {stderr.decode(errors='replace').strip()}")
+    return json.loads(stdout)
+
+
+def duration(info: dict) -> float:
+    return float(info.get("format", {}).get("duration") or 0)
+
+
+def summarize(info: dict) -> dict:
+    """Reduce ffprobe output to the fields the render pipeline decides on"""
+    streams = info.get("streams", [])
+    video = next(
+        (
+            s
+            for s in streams
+            if s.get("codec_type") == "video"
+            and not s.get("disposition", {}).get("attached_pic")
+        ),
+        None,
+    )
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    media = {
+        "duration": duration(info),
+        "has_video": video is not None,
+        "has_audio": audio is not None,
+        "acodec": audio.get("codec_name") if audio else None,
+        # set by this service on everything it encodes, see EncodeProfile.stamp
+        "comment": info.get("format", {}).get("tags", {}).get("comment"),
+    }
+    if video is not None:
+        media.update(
+            vcodec=video.get("codec_name"),
+            profile=video.get("profile"),
+            width=video.get("width"),
+            height=video.get("height"),
+            fps=_frame_rate(video.get("avg_frame_rate") or video.get("r_frame_rate")),
+            pix_fmt=video.get("pix_fmt"),
+            sar=video.get("sample_aspect_ratio"),
+        )
+    return media
+
+
+def has_square_pixels(media: dict) -> bool:
+    return media.get("sar") in (None, "0:1", "1:1")
+
+
+def matches_geometry(media: dict, width: int, height: int, fps: int) -> bool:
+    return (
+        media.get("width") == width
+        and media.get("height") == height
+        and has_square_pixels(media)
+        and media.get("fps") is not None
+        and abs(media["fps"] - fps) < 0.01
+    )
+
+
+def _frame_rate(value: str | None) -> float | None:
+    try:
+        rate = Fraction(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return float(rate) if rate else None
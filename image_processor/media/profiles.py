@@ -0,0 +1,98 @@
+import hashlib
+import json
+from dataclasses import asdict, dataclass
+
+
+@dataclass(frozen=True)
+class EncodeProfile:
+    name: str
+    preset: str
+    # constant quality when set, otherwise video_bitrate is the target
+    crf: int | None
+    video_bitrate: str | None
+    width: int
+    height: int
+    fps: int
+    audio_bitrate: str
+    sample_rate: int
+    # CPU threads one encode of this profile takes from the render budget
+    threads: int
+    # what libx264 reports for the preset, needed to stream copy source clips
+    h264_profile: str
+
+    def output_params(self) -> dict:
+        """Everything that changes the rendered media, used in cache keys"""
+        params = asdict(self)
+        del params["name"], params["threads"]
+        return params
+
+    def stamp(self) -> str:
+        """Comment tag written into media this service encodes with these settings"""
+        params = json.dumps(self.output_params(), sort_keys=True).encode()
+        return f"image_processor:{hashlib.sha256(params).hexdigest()[:16]}"
+
+
+PROFILES: dict[str, EncodeProfile] = {
+    profile.name: profile
+    for profile in (
+        EncodeProfile(
+            name="preview",
+            preset="ultrafast",
+            crf=None,
+            video_bitrate="400k",
+            width=360,
+            height=640,
+            fps=30,
+            audio_bitrate="64k",
+            sample_rate=44100,
+            threads=1,
+            h264_profile="Constrained Baseline",
+        ),
+        EncodeProfile(
+            name="draft",
+            preset="ultrafast",
+            crf=None,
+            video_bitrate="800k",
+            width=540,
+            height=960,
+            fps=30,
+            audio_bitrate="96k",
+            sample_rate=44100,
+            threads=1,
+            h264_profile="Constrained Baseline",
+        ),
+        EncodeProfile(
+            name="standard",
+            preset="ultrafast",
+            crf=None,
+            video_bitrate="2M",
+            width=720,
+            height=1280,
+            fps=30,
+            audio_bitrate="128k",
+            sample_rate=44100,
+            threads=2,
+            h264_profile="Constrained Baseline",
+        ),
+        EncodeProfile(
+            name="high",
+            preset="veryfast",
+            crf=20,
+            video_bitrate=None,
+            width=1080,
+            height=1920,
+            fps=30,
+            audio_bitrate="192k",
+            sample_rate=48000,
+            threads=4,
+            h264_profile="High",
+        ),
+    )
+}
+
+
+def get_profile(name: str) -> EncodeProfile:
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise Exception(f"Unknown encode profile {name}") from None
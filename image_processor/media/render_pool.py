@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import math
+import os
+import re
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+# receives the key=value block ffmpeg writes with -progress after every update
+ProgressCallback = Callable[[dict[str, str]], None]
+
+_PROGRESS_LINE = re.compile(rb"^([a-z0-9_]+)=(\S*)$")
+
+# set for work someone is waiting on, inherited by the tasks it creates
+_URGENT: ContextVar[bool] = ContextVar("render_urgent", default=False)
+
+
+def available_cpus() -> int:
+    """Number of CPUs usable by this process, honouring affinity and cgroup quota"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+class RenderPool:
+    """Runs ffmpeg processes within a budget of CPU threads"""
+
+    def __init__(self, logger: logging.Logger, threads: int = 0):
+        self._budget = threads or available_cpus()
+        self._free = self._budget
+        # FIFO so a wide encode is not starved by a stream of narrow ones
+        self._waiters: deque[tuple[int, asyncio.Future]] = deque()
+        # served before _waiters so previews never queue behind full jobs
+        self._urgent_waiters: deque[tuple[int, asyncio.Future]] = deque()
+        self._processes: set[asyncio.subprocess.Process] = set()
+        self._logger = logger
+        self._logger.info(f"Render pool: {self._budget} threads")
+
+    @property
+    def budget(self) -> int:
+        return self._budget
+
+    def stats(self) -> dict:
+        return {
+            "threads": self._budget,
+            "busy": self._budget - self._free,
+            "waiting": len(self._waiters) + len(self._urgent_waiters),
+            "urgent": len(self._urgent_waiters),
+        }
+
+    @contextmanager
+    def urgent(self):
+        """Let the renders started within jump ahead of queued ones"""
+        token = _URGENT.set(True)
+        try:
+            yield
+        finally:
+            _URGENT.reset(token)
+
+    @asynccontextmanager
+    async def _reserve(self, threads: int):
+        threads = max(1, min(threads, self._budget))
+        waiters = self._urgent_waiters if _URGENT.get() else self._waiters
+        if self._urgent_waiters or waiters or self._free < threads:
+            waiter = asyncio.get_running_loop().create_future()
+            waiters.append((threads, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if not waiter.cancelled():
+                    # granted just before the cancellation arrived
+                    self._release(threads)
+                elif (threads, waiter) in waiters:
+                    waiters.remove((threads, waiter))
+                    self._wake()
+                raise
+        else:
+            self._free -= threads
+        try:
+            yield
+        finally:
+            self._release(threads)
+
+    def _release(self, threads: int):
+        self._free += threads
+        self._wake()
+
+    def _wake(self):
+        for waiters in (self._urgent_waiters, self._waiters):
+            while waiters and waiters[0][0] <= self._free:
+                threads, waiter = waiters.popleft()
+                if waiter.cancelled():
+                    continue
+                self._free -= threads
+                waiter.set_result(None)
+            if waiters:
+                return
+
+    async def run(
+        self, args: list[str], threads: int = 1, on_progress: ProgressCallback | None = None
+    ):
+        async with self._reserve(threads):
+            process = await asyncio.create_subprocess_exec(
+                *self._with_progress(args, on_progress),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            self._processes.add(process)
+            try:
+                stderr = await self._read_stderr(process.stderr, on_progress)
+                await process.wait()
+            except asyncio.CancelledError:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                raise
+            finally:
+                self._processes.discard(process)
+
+        self._check(process.returncode, stderr)
+
+    async def stream(
+        self,
+        args: list[str],
+        consumer: Callable[
+            [asyncio.StreamReader, Callable[[], Awaitable[None]]], Awaitable[T]
+        ],
+        threads: int = 1,
+        on_progress: ProgressCallback | None = None,
+    ) -> T:
+        """Run ffmpeg writing to stdout, passing the stream and an exit check to consumer"""
+        async with self._reserve(threads):
+            process = await asyncio.create_subprocess_exec(
+                *self._with_progress(args, on_progress),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            self._processes.add(process)
+            stderr_task = asyncio.create_task(
+                self._read_stderr(process.stderr, on_progress)
+            )
+
+            async def _finished():
+                await process.wait()
+                self._check(process.returncode, await stderr_task)
+
+            try:
+                return await consumer(process.stdout, _finished)
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                stderr_task.cancel()
+                self._processes.discard(process)
+
+    async def close(self):
+        """Kill ffmpeg processes still running, so none outlive the worker"""
+        for process in list(self._processes):
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        self._processes.clear()
+
+    @staticmethod
+    def _with_progress(args: list[str], on_progress: ProgressCallback | None) -> list[str]:
+        if on_progress is None:
+            return args
+        # machine readable progress on stderr instead of the interactive status line
+        return [args[0], "-progress", "pipe:2", "-nostats", *args[1:]]
+
+    @staticmethod
+    async def _read_stderr(
+        stream: asyncio.StreamReader, on_progress: ProgressCallback | None
+    ) -> bytes:
+        """Collect ffmpeg's messages, handing -progress blocks to on_progress"""
+        if on_progress is None:
+            return await stream.read()
+        output = []
+        block: dict[str, str] = {}
+        async for line in stream:
+            match = _PROGRESS_LINE.match(line.strip())
+            if match is None:
+                output.append(line)
+                continue
+            key, value = match.group(1).decode(), match.group(2).decode()
+            block[key] = value
+            if key == "progress":
+                on_progress(block)
+                block = {}
+        return b"".join(output)
+
+    @staticmethod
+    def _check(returncode: int, stderr: bytes):
+        if returncode != 0:
+            lines = stderr.decode(errors="replace").strip().splitlines()
+            raise Exception(
+                f"ffmpeg exited with {returncode}: {lines[-1] if lines else ''}"
+            )
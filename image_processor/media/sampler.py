@@ -0,0 +1,41 @@
+import math
+import random
+import sys
+from typing import Iterator, Sequence, TypeVar
+
+T = TypeVar("T")
+
+
+def combination_count(blocks: Sequence[Sequence[T]]) -> int:
+    return math.prod(len(block) for block in blocks)
+
+
+def combination_at(blocks: Sequence[Sequence[T]], index: int) -> tuple[T, ...]:
+    """Decode index as a mixed-radix number whose digits pick one item per block"""
+    picked = []
+    for block in reversed(blocks):
+        index, digit = divmod(index, len(block))
+        picked.append(block[digit])
+    return tuple(reversed(picked))
+
+
+def sample_combinations(
+    blocks: Sequence[Sequence[T]], count: int, rng: random.Random
+) -> Iterator[tuple[T, ...]]:
+    """Yield a uniform random subset of count distinct combinations without building the product"""
+    total = combination_count(blocks)
+    count = min(count, total)
+    if total <= sys.maxsize:
+        # sample() draws from a range lazily, memory stays proportional to count
+        for index in rng.sample(range(total), count):
+            yield combination_at(blocks, index)
+        return
+    # sample() needs len() of the range; a product this large dwarfs any count,
+    # so drawing again on a repeat almost never happens
+    seen = set()
+    while len(seen) < count:
+        index = rng.randrange(total)
+        if index in seen:
+            continue
+        seen.add(index)
+        yield combination_at(blocks, index)
@@ -1,5 +1,11 @@
+import hashlib
+import json
+
 from pydantic import Field, HttpUrl, field_validator
 
+from image_processor.config import get_settings
+from image_processor.media.profiles import PROFILES
+from image_processor.media.sampler import combination_count
 from image_processor.models import AppBase
 
 
@@ -13,6 +19,14 @@ class CreateMediaSchema(AppBase):
     video_blocks: dict[str, list[HttpUrl]] = Field(min_length=1, max_length=10)
     audio_blocks: dict[str, list[HttpUrl]] = Field(min_length=1)
     text_to_speech: list[TextToSpeechSchema] = Field(min_length=1)
+    # render a random subset of the combinations instead of all of them
+    max_outputs: int | None = Field(default=None, ge=1)
+    # fixes which combinations, music and speech orders are picked
+    seed: int | None = None
+    # encode profile name, DEFAULT_ENCODE_PROFILE when omitted
+    profile: str | None = None
+    # quick low resolution look at a few combinations on the fast lane queue
+    preview: bool = False
 
     @field_validator("video_blocks", "audio_blocks")
     @classmethod
@@ -21,3 +35,55 @@ class CreateMediaSchema(AppBase):
             if not url_list:
                 raise ValueError(f"The list for block '{key}' cannot be empty.")
         return v
+
+    @field_validator("profile")
+    @classmethod
+    def known_profile(cls, v: str | None) -> str | None:
+        if v is not None and v not in PROFILES:
+            raise ValueError(f"Unknown profile '{v}', expected one of {', '.join(PROFILES)}.")
+        return v
+
+    def ordered_video_blocks(self) -> list[list[HttpUrl]]:
+        return [self.video_blocks[key] for key in sorted(self.video_blocks)]
+
+    def fingerprint(self) -> str:
+        """Hash of everything that decides the outputs, equal for resubmitted payloads"""
+        # lists keep their order: it decides which part gets which combination,
+        # music and speech order
+        canonical = {
+            "task_name": self.task_name,
+            "video_blocks": [
+                [str(url) for url in block] for block in self.ordered_video_blocks()
+            ],
+            "audio": [str(url) for urls in self.audio_blocks.values() for url in urls],
+            "text_to_speech": [[s.text, s.voice] for s in self.text_to_speech],
+            "profile": self.profile or get_settings().DEFAULT_ENCODE_PROFILE,
+            "outputs": self.output_count(),
+            "seed": self.seed,
+            "preview": self.preview,
+        }
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+    def output_count(self) -> int:
+        total = combination_count(self.ordered_video_blocks())
+        count = min(self.max_outputs or total, total)
+        if self.preview:
+            count = min(count, get_settings().PREVIEW_OUTPUTS)
+        return count
+
+
+class RenderPartSchema(AppBase):
+    index: int = Field(ge=0)
+    video_urls: list[HttpUrl] = Field(min_length=1)
+    audio_url: HttpUrl
+    speech: list[TextToSpeechSchema] = Field(min_length=1)
+
+
+class RenderBatchSchema(AppBase):
+    task_id: str
+    task_name: str
+    # batches queued before profiles existed were rendered as standard
+    profile: str = "standard"
+    # renders only the first seconds of every clip
+    clip_seconds: float | None = None
+    parts: list[RenderPartSchema] = Field(min_length=1)
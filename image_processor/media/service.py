@@ -1,245 +1,1140 @@
 import asyncio
+import hashlib
+import json
 import logging
+import math
 import os
 import uuid
 import random
-import aiohttp
+import time
 import ffmpeg
-from itertools import product
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Iterator, TypeVar
 
 from fastapi import HTTPException, status
 
 from image_processor.broker import Broker
-from image_processor.core.constants import FILE_CHUNK_SIZE
+from image_processor.config import get_settings
+from image_processor.core.async_io import aopen, run_io
+from image_processor.core.disk_cache import CacheEntry, DiskCache
+from image_processor.core.http_pool import HttpPool
 from image_processor.core.timer import timer
-from image_processor.errors.messages import GOOGLE_AUTH_ERROR, ELEVENLAB_AUTH_ERROR
+from image_processor.errors.messages import (
+    BACKLOG_FULL_ERROR,
+    ELEVENLAB_AUTH_ERROR,
+    GOOGLE_AUTH_ERROR,
+    IDEMPOTENCY_KEY_REUSED_ERROR,
+    TASK_NOT_CANCELLABLE_ERROR,
+    TASK_NOT_FOUND_ERROR,
+    TOO_MANY_OUTPUTS_ERROR,
+)
+from image_processor.errors.exceptions import InvalidMediaError, InvalidMessageError
 from image_processor.google_clients.google_drive_client import GoogleDriveClient
+from image_processor.media import probe
+from image_processor.media.asset_cache import AssetCache
 from image_processor.media.elevenlabs_client import ElevenLabsClient
-from image_processor.media.schema import CreateMediaSchema
+from image_processor.media.cost import estimate_cost, priority
+from image_processor.media.profiles import EncodeProfile, get_profile
+from image_processor.media.render_pool import ProgressCallback, RenderPool
+from image_processor.media.sampler import combination_count, sample_combinations
+from image_processor.media.schema import (
+    CreateMediaSchema,
+    RenderBatchSchema,
+    RenderPartSchema,
+)
+from image_processor.tasks.progress import BatchProgress, summarize
+from image_processor.tasks.store import TaskStore
+
+T = TypeVar("T")
 
 
 class MediaService:
+    PREMIX_STEP = 10  # seconds
+    VIDEO_TIMESCALE = 15360
+
     def __init__(
         self,
         google_drive_client: GoogleDriveClient,
         broker: Broker,
         logger: logging.Logger,
         eleven_labs_client: ElevenLabsClient,
+        render_pool: RenderPool | None,
+        asset_cache: AssetCache | None,
+        http_pool: HttpPool,
+        task_store: TaskStore,
+        premix_cache: DiskCache | None,
+        segment_cache: DiskCache | None,
     ):
+        """The render pool and caches are None in an API process that does not consume"""
         self._google_drive_client = google_drive_client
         self._broker = broker
         self._logger = logger
         self._eleven_labs_client = eleven_labs_client
+        self._render_pool = render_pool
+        self._asset_cache = asset_cache
+        self._http_pool = http_pool
+        self._task_store = task_store
+        self._premix_cache = premix_cache
+        self._segment_cache = segment_cache
+        # work of each task running in this process, so it can be cancelled
+        self._running: dict[str, set[asyncio.Task]] = {}
+        self._reported_unauthorized: dict[str, float] = {}
+        self._background: set[asyncio.Task] = set()
 
-    async def save_file(self, media_payload: CreateMediaSchema):
-        is_google_client_valid = await self._google_drive_client.is_valid()
+    async def save_file(
+        self, media_payload: CreateMediaSchema, idempotency_key: str | None = None
+    ) -> dict:
+        """Queue a job, or attach to an identical one submitted before.
+
+        Jobs are matched by the client's Idempotency-Key when given, otherwise
+        by the payload fingerprint.
+        """
+        outputs, limit = media_payload.output_count(), get_settings().MAX_OUTPUTS_PER_TASK
+        if outputs > limit:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_CONTENT,
+                detail=TOO_MANY_OUTPUTS_ERROR.format(outputs=outputs, limit=limit),
+            )
+        is_google_client_valid, is_eleven_labs_client_valid = await asyncio.gather(
+            self._google_drive_client.is_authorized(),
+            self._eleven_labs_client.is_authorized(),
+        )
         if not is_google_client_valid:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail=GOOGLE_AUTH_ERROR,
             )
-        is_eleven_labs_client_valid = await self._eleven_labs_client.is_valid()
         if not is_eleven_labs_client_valid:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail=ELEVENLAB_AUTH_ERROR,
             )
-        await self._broker.publish(media_payload)
 
-    @timer
-    async def process_task(self, payload: CreateMediaSchema):
-        video_map, audio_list, speech_list, all_assets = await self._prepare_assets(
-            payload
+        settings = get_settings()
+        fingerprint = media_payload.fingerprint()
+        if idempotency_key is not None:
+            key = hashlib.sha256(f"idempotency:{idempotency_key}".encode()).hexdigest()
+        else:
+            key = fingerprint
+        existing = await self._task_store.find(
+            key, settings.ADMISSION_STALE_AFTER, settings.DEDUP_WINDOW
+        )
+        if existing is not None:
+            return self._duplicate(existing, fingerprint)
+
+        durations = await run_io(self._cached_durations, media_payload)
+        cost = estimate_cost(media_payload, durations)
+        backlog = await self._task_store.backlog(settings.ADMISSION_STALE_AFTER)
+        wait = backlog / settings.RENDER_THROUGHPUT
+        if settings.ADMISSION_MAX_BACKLOG and wait > settings.ADMISSION_MAX_BACKLOG:
+            retry_after = math.ceil(wait - settings.ADMISSION_MAX_BACKLOG)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=BACKLOG_FULL_ERROR.format(
+                    eta=math.ceil(wait), retry_after=retry_after
+                ),
+                headers={"Retry-After": str(retry_after)},
+            )
+
+        job_priority = priority(cost, settings.QUEUE_MAX_PRIORITY)
+        record, created = await self._task_store.claim(
+            key,
+            settings.ADMISSION_STALE_AFTER,
+            settings.DEDUP_WINDOW,
+            uuid.uuid4().hex,
+            media_payload.task_name,
+            outputs,
+            status=TaskStore.QUEUED,
+            cost=cost,
+            priority=job_priority,
+            fingerprint=fingerprint,
+        )
+        if not created:
+            # an identical request won the race since the lookup above
+            return self._duplicate(record, fingerprint)
+        task_id = record["task_id"]
+        try:
+            await self._broker.publish(media_payload, task_id, job_priority)
+        except Exception:
+            await self._task_store.update(task_id, status=TaskStore.FAILED)
+            raise
+        self._logger.info(
+            f"Queued {media_payload.task_name} with cost {cost:.0f}s, priority {job_priority}"
+        )
+        return {
+            "status": "uploaded",
+            "task_id": task_id,
+            "eta": math.ceil((backlog + cost) / settings.RENDER_THROUGHPUT),
+        }
+
+    def _duplicate(self, record: dict, fingerprint: str) -> dict:
+        if record.get("fingerprint") != fingerprint:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_CONTENT,
+                detail=IDEMPOTENCY_KEY_REUSED_ERROR.format(task_id=record["task_id"]),
+            )
+        summary = summarize(record, get_settings().RENDER_THROUGHPUT)
+        self._logger.info(
+            f"{record['task_name']} is a duplicate of {record['task_id']} ({record['status']})"
+        )
+        return {
+            "status": "duplicate",
+            "task_id": record["task_id"],
+            "task_status": record["status"],
+            "eta": summary["eta"],
+            "file_ids": summary["file_ids"],
+        }
+
+    @staticmethod
+    def _cached_durations(media_payload: CreateMediaSchema) -> dict[str, float]:
+        """Durations the workers probed for the payload's clips, from the shared asset index"""
+        durations = {}
+        for url in {str(u) for block in media_payload.ordered_video_blocks() for u in block}:
+            duration = AssetCache.cached_duration(get_settings().ASSET_CACHE_DIR, url)
+            if duration:
+                durations[url] = duration
+        return durations
+
+    async def get_task_status(self, task_id: str) -> dict:
+        record = await self._task_store.get(task_id)
+        if record is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=TASK_NOT_FOUND_ERROR.format(task_id=task_id),
+            )
+        return summarize(record, get_settings().RENDER_THROUGHPUT)
+
+    async def cancel_task(self, task_id: str) -> dict:
+        """Mark a task cancelled and tell every worker to stop its running work"""
+        record = await self._task_store.cancel(task_id)
+        if record is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=TASK_NOT_FOUND_ERROR.format(task_id=task_id),
+            )
+        if record["status"] != TaskStore.CANCELLED:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=TASK_NOT_CANCELLABLE_ERROR.format(
+                    task_id=task_id, status=record["status"]
+                ),
+            )
+        await self._broker.publish_control({"action": "cancel", "task_id": task_id})
+        await self._broker.publish_event(
+            {
+                "event": "task_cancelled",
+                "task_id": task_id,
+                "task_name": record["task_name"],
+            }
         )
-        generated_parts = []
+        self._logger.info(f"Cancelled task {task_id}")
+        return record
+
+    def handle_control(self, message: dict):
+        """React to a message broadcast to all workers and API processes"""
+        if message.get("action") == "invalidate_credentials":
+            client = self._clients().get(message.get("client"))
+            if client is not None:
+                client.validation.invalidate(notify=False)
+            return
+        if message.get("action") != "cancel":
+            return
+        running = self._running.get(message["task_id"], ())
+        if running:
+            self._logger.info(f"Stopping {len(running)} job(s) of task {message['task_id']}")
+        for task in running:
+            task.cancel()
 
+    def report_unauthorized(self, client: str):
+        """Make every process, the API included, check the client's credentials again"""
+        now = time.monotonic()
+        # a revoked key fails every request of a batch, one broadcast is enough
+        if now - self._reported_unauthorized.get(client, -math.inf) < 10:
+            return
+        self._reported_unauthorized[client] = now
+        task = asyncio.ensure_future(
+            self._broker.publish_control(
+                {"action": "invalidate_credentials", "client": client}
+            )
+        )
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _clients(self) -> dict:
+        return {
+            "google_drive": self._google_drive_client,
+            "eleven_labs": self._eleven_labs_client,
+        }
+
+    async def _cancellable(self, task_id: str, work: Awaitable[T]) -> T | None:
+        """Run work for a task, returning None if the task gets cancelled meanwhile"""
+        running = self._running.setdefault(task_id, set())
+        if asyncio.current_task() in running:
+            # nested, e.g. the batch of a preview; stopping the outer task is enough
+            return await work
+        task = asyncio.ensure_future(work)
+        running.add(task)
         try:
-            sorted_block_keys = sorted(payload.video_blocks.keys())
-            block_lists = []
-            for key in sorted_block_keys:
-                paths = [video_map[u] for u in payload.video_blocks[key]]
-                block_lists.append(paths)
-
-            combinations = list(product(*block_lists))
-            self._logger.info(f"Found {len(combinations)} combinations to generate.")
-            random.shuffle(combinations)
-            for i, video_combo in enumerate(combinations):
-                selected_audio = random.choice(audio_list)
-                current_speech_list = list(speech_list)
-                random.shuffle(current_speech_list)
-                part_path = await self._generate_part(
-                    i, list(video_combo), selected_audio, current_speech_list
+            return await task
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                # the worker itself is stopping, not the task
+                raise
+            self._logger.info(f"Task {task_id} was cancelled while running")
+            return None
+        finally:
+            running.discard(task)
+            if not running:
+                self._running.pop(task_id, None)
+
+    @timer
+    async def process_task(
+        self, payload: CreateMediaSchema, task_id: str | None, last_attempt: bool = True
+    ):
+        """Split a job into render batches that any worker can pick up"""
+        if task_id is None:
+            # published before task ids existed, the job gets a record here
+            task_id = uuid.uuid4().hex
+            record = await self._task_store.create(task_id, payload.task_name, 0)
+        else:
+            record = await self._task_store.get(task_id)
+        if record is None:
+            raise InvalidMessageError(self._missing_record(task_id))
+        if record["status"] in (TaskStore.CANCELLED, TaskStore.FAILED):
+            self._logger.info(f"Task {task_id} is {record['status']}, skipping")
+            return
+        if record.get("planned"):
+            self._logger.info(f"Task {task_id} was already split, skipping")
+            return
+        try:
+            await self._cancellable(
+                task_id, self._plan_task(payload, record, last_attempt)
+            )
+        except Exception as e:
+            if last_attempt:
+                await self._task_store.update(
+                    task_id, status=TaskStore.FAILED, error=str(e)
+                )
+            # the broker retries the job, or dead-letters it after the last attempt
+            raise
+
+    async def _plan_task(
+        self, payload: CreateMediaSchema, record: dict, last_attempt: bool
+    ):
+        task_id = record["task_id"]
+        # without a seed the task id keeps a redelivered job on the same parts
+        rng = random.Random(payload.seed if payload.seed is not None else task_id)
+        block_lists = payload.ordered_video_blocks()
+        total = combination_count(block_lists)
+        outputs = min(payload.output_count(), get_settings().MAX_OUTPUTS_PER_TASK)
+        self._logger.info(f"Found {total} combinations, generating {outputs}.")
+        # this task can be stopped from here on; a cancel that came earlier
+        # found nothing running and is only visible in the record
+        record = await self._task_store.start(task_id, total=outputs)
+        if record["status"] == TaskStore.CANCELLED:
+            self._logger.info(f"Task {task_id} was cancelled, skipping")
+            return
+
+        if payload.preview:
+            await self._render_preview(
+                payload, task_id, block_lists, outputs, rng, last_attempt
+            )
+            return
+
+        profile = payload.profile or get_settings().DEFAULT_ENCODE_PROFILE
+        batch_size = get_settings().RENDER_BATCH_SIZE
+        # the seeded plan is the same on a retry, so batches published by an
+        # earlier attempt are skipped rather than rendered twice
+        published = record.get("published", 0)
+        batches = 0
+        batch = []
+        for part in self._plan_parts(payload, block_lists, outputs, rng):
+            batch.append(part)
+            if len(batch) == batch_size:
+                batches = await self._publish_batch(
+                    record, profile, batch, batches, published
                 )
-                generated_parts.append(part_path)
+                batch = []
+        if batch:
+            await self._publish_batch(record, profile, batch, batches, published)
+        await self._task_store.update(task_id, planned=True)
+        self._logger.info(
+            f"Split {payload.task_name} into {outputs} parts on {self._broker.parts_queue_name}"
+        )
 
-            await self._stitch_and_upload(generated_parts, payload.task_name)
-            self._logger.info(f"Finished processing {payload.task_name}")
+    async def _render_preview(
+        self,
+        payload: CreateMediaSchema,
+        task_id: str,
+        block_lists: list[list],
+        outputs: int,
+        rng: random.Random,
+        last_attempt: bool,
+    ):
+        """Render the few parts of a preview here instead of fanning them out"""
+        batch = RenderBatchSchema(
+            task_id=task_id,
+            task_name=payload.task_name,
+            profile=get_settings().PREVIEW_PROFILE,
+            clip_seconds=get_settings().PREVIEW_CLIP_SECONDS,
+            parts=list(self._plan_parts(payload, block_lists, outputs, rng)),
+        )
+        with self._render_pool.urgent():
+            await self.process_batch(batch, last_attempt)
+        await self._task_store.update(task_id, planned=True)
+
+    @staticmethod
+    def _plan_parts(
+        payload: CreateMediaSchema,
+        block_lists: list[list],
+        outputs: int,
+        rng: random.Random,
+    ) -> Iterator[RenderPartSchema]:
+        audio_urls = [url for urls in payload.audio_blocks.values() for url in urls]
+        # a bounded set of (music, speech order) pairs so their pre-mixed
+        # tracks are rendered once and shared between parts
+        audio_variants = []
+        for _ in range(get_settings().AUDIO_VARIANTS):
+            speech = list(payload.text_to_speech)
+            rng.shuffle(speech)
+            audio_variants.append((rng.choice(audio_urls), speech))
+        for index, video_combo in enumerate(
+            sample_combinations(block_lists, outputs, rng)
+        ):
+            audio_url, speech = rng.choice(audio_variants)
+            yield RenderPartSchema(
+                index=index,
+                video_urls=list(video_combo),
+                audio_url=audio_url,
+                speech=speech,
+            )
+
+    async def _publish_batch(
+        self,
+        record: dict,
+        profile: str,
+        parts: list[RenderPartSchema],
+        batches: int,
+        published: int,
+    ) -> int:
+        """Publish the batch unless an earlier attempt did, returning the new batch count"""
+        batches += 1
+        if batches <= published:
+            return batches
+        await self._broker.publish_batch(
+            RenderBatchSchema(
+                task_id=record["task_id"],
+                task_name=record["task_name"],
+                profile=profile,
+                parts=parts,
+            ),
+            # batches keep the job's priority so they are not overtaken by longer jobs
+            record.get("priority", 0),
+        )
+        await self._task_store.update(record["task_id"], published=batches)
+        return batches
+
+    @timer
+    async def process_batch(self, batch: RenderBatchSchema, last_attempt: bool = True):
+        """Render and upload a batch of parts, then record them on the task.
+
+        Uploads are recorded as they finish, so a retried batch only renders the
+        parts still missing. Failures are retried unless they are permanent or
+        this is the last attempt, in which case the parts are recorded as failed.
+        """
+        record = await self._task_store.get(batch.task_id)
+        if record is None:
+            # rendering anyway would upload files no job ever reports
+            raise InvalidMessageError(self._missing_record(batch.task_id))
+        if record["status"] == TaskStore.CANCELLED:
+            self._logger.info(f"Task {batch.task_id} was cancelled, skipping batch")
+            await self._discard_parts(batch.task_id, [part.index for part in batch.parts])
+            return
+        done = record["parts"]
+        pending = [part for part in batch.parts if str(part.index) not in done]
+        if not pending:
+            self._logger.info(f"Batch of {batch.task_name} was already done, skipping")
+            return
+
+        progress = BatchProgress(
+            self._task_store,
+            batch.task_id,
+            str(min(part.index for part in batch.parts)),
+            len(batch.parts),
+            get_settings().PROGRESS_INTERVAL,
+            self._logger,
+        )
+        progress.add("rendered", len(batch.parts) - len(pending))
+        progress.start()
+
+        async def _checkpoint(index: int, file_id: str):
+            await self._record_parts(batch.task_id, {index: file_id})
+
+        results = None
+        try:
+            results = await self._cancellable(
+                batch.task_id,
+                self._render_batch(
+                    batch.model_copy(update={"parts": pending}), progress, _checkpoint
+                ),
+            )
+        except asyncio.CancelledError:
+            # a cancelled preview stops its planning task with the batch inside
+            record = await self._task_store.get(batch.task_id)
+            if record is not None and record["status"] == TaskStore.CANCELLED:
+                await self._discard_parts(batch.task_id, [part.index for part in pending])
+            raise
         except Exception as e:
-            self._logger.error(
-                f"Worker error: {e} during consuming {payload.task_name}"
+            self._logger.error(f"Worker error: {e} during consuming {batch.task_name}")
+            results = {part.index: e for part in pending}
+        finally:
+            await progress.close("cancelled" if results is None else "done")
+        if results is None:
+            await self._discard_parts(batch.task_id, [part.index for part in pending])
+            return
+
+        failed = {i: r for i, r in results.items() if isinstance(r, Exception)}
+        self._logger.info(
+            f"Uploaded {len(results) - len(failed)}/{len(results)} parts "
+            f"of batch of {batch.task_name}"
+        )
+        retryable = {
+            i: e for i, e in failed.items() if not isinstance(e, InvalidMediaError)
+        }
+        if retryable and not last_attempt:
+            # permanent failures are final, the rest is rendered again on retry
+            permanent = {i: e for i, e in failed.items() if i not in retryable}
+            await self._record_parts(batch.task_id, permanent)
+            await self._discard_parts(batch.task_id, list(permanent))
+            raise Exception(
+                f"{len(retryable)} part(s) of {batch.task_name} failed: "
+                f"{next(iter(retryable.values()))}"
+            )
+        await self._record_parts(batch.task_id, failed)
+        await self._discard_parts(batch.task_id, list(failed))
+
+    @staticmethod
+    def _missing_record(task_id: str) -> str:
+        return (
+            f"Task {task_id} has no record in {get_settings().TASKS_DIR}, "
+            f"the API and every worker must share this directory on one host"
+        )
+
+    async def _discard_parts(self, task_id: str, indexes: list[int]):
+        """Drop kept renders and upload sessions of parts that will not be resumed"""
+        for index in indexes:
+            await self._google_drive_client.discard_upload(self._part_key(task_id, index))
+            path = self._part_path(task_id, index)
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def _part_key(task_id: str, index: int) -> str:
+        return f"{task_id}_{index}"
+
+    @classmethod
+    def _part_path(cls, task_id: str, index: int) -> str:
+        return os.path.join(
+            get_settings().PARTS_DIR, f"{cls._part_key(task_id, index)}.mp4"
+        )
+
+    async def _record_parts(self, task_id: str, results: dict[int, str | Exception]):
+        if not results:
+            return
+        record = await self._task_store.complete_parts(task_id, results)
+        if record is not None:
+            await self._publish_finished(record)
+
+    async def _publish_finished(self, record: dict):
+        parts = record["parts"]
+        file_ids = [parts[i]["file_id"] for i in sorted(parts, key=int) if parts[i]["file_id"]]
+        await self._broker.publish_event(
+            {
+                "event": "task_finished",
+                "task_id": record["task_id"],
+                "task_name": record["task_name"],
+                "status": record["status"],
+                "uploaded": len(file_ids),
+                "failed": record["total"] - len(file_ids),
+                "file_ids": file_ids,
+            }
+        )
+        self._logger.info(
+            f"Finished processing {record['task_name']}: {len(file_ids)}/{record['total']} uploaded"
+        )
+
+    async def _render_batch(
+        self,
+        batch: RenderBatchSchema,
+        progress: BatchProgress,
+        on_uploaded: Callable[[int, str], Awaitable[None]],
+    ) -> dict[int, str | Exception]:
+        profile = get_profile(batch.profile)
+        video_urls = list(dict.fromkeys(str(u) for p in batch.parts for u in p.video_urls))
+        audio_urls = list(dict.fromkeys(str(p.audio_url) for p in batch.parts))
+        speech = list(
+            dict.fromkeys((s.text, s.voice) for p in batch.parts for s in p.speech)
+        )
+        video_map, audio_map, speech_map, assets, speech_entries = (
+            await self._prepare_assets(video_urls, audio_urls, speech, progress)
+        )
+        progress.set(stage="render")
+        normalized_clips: dict[str, asyncio.Task] = {}
+        clip_durations: dict[str, asyncio.Task] = {}
+        premixes: dict[tuple[str, tuple[str, ...]], asyncio.Task] = {}
+
+        try:
+            # parts using an asset that could not be fetched or lacks the stream
+            # it is used for fail before any CPU is spent; the others still render
+            failed = self._unusable_parts(batch.parts, video_map, audio_map, speech_map)
+            for index, error in failed.items():
+                self._logger.error(f"Part {index} of {batch.task_name} failed: {error}")
+            usable = [part for part in batch.parts if part.index not in failed]
+            if not usable:
+                return failed
+
+            for url in dict.fromkeys(str(u) for p in usable for u in p.video_urls):
+                entry = video_map[url]
+                normalized_clips[url] = asyncio.create_task(
+                    self._normalize_clip(entry, profile, batch.clip_seconds, progress)
+                )
+                clip_durations[url] = asyncio.create_task(
+                    self._clip_duration(entry, normalized_clips[url], batch.clip_seconds)
+                )
+            part_mixes = {
+                part.index: (
+                    audio_map[str(part.audio_url)].path,
+                    tuple(speech_map[(s.text, s.voice)] for s in part.speech),
+                )
+                for part in usable
+            }
+            mixes: dict[tuple[str, tuple[str, ...]], list[RenderPartSchema]] = {}
+            for part in usable:
+                mixes.setdefault(part_mixes[part.index], []).append(part)
+            for (audio_path, speech_paths), mix_parts in mixes.items():
+                premixes[(audio_path, speech_paths)] = asyncio.create_task(
+                    self._premix_audio(
+                        audio_path,
+                        list(speech_paths),
+                        [[clip_durations[str(u)] for u in p.video_urls] for p in mix_parts],
+                        profile,
+                        progress,
+                    )
+                )
+
+            parts = [
+                (
+                    part.index,
+                    [normalized_clips[str(u)] for u in part.video_urls],
+                    premixes[part_mixes[part.index]],
+                )
+                for part in usable
+            ]
+            results = await self._render_and_upload(
+                batch.task_id, batch.task_name, parts, profile, progress, on_uploaded
             )
+            return dict(sorted({**failed, **results}.items()))
         finally:
-            for f in all_assets:
-                if os.path.exists(f):
-                    os.remove(f)
-            for f in generated_parts:
-                if os.path.exists(f):
-                    os.remove(f)
-
-    async def _prepare_assets(self, payload: CreateMediaSchema):
-        temp_files = []
-        video_map = {}
-        speech_semaphore = asyncio.Semaphore(1)
-
-        async def _get_speech_audio(s, text, voice):
-            async with speech_semaphore:
-                await asyncio.sleep(0.5)
-                return await self._eleven_labs_client.get_speech_by_text(s, text, voice)
-
-        async with aiohttp.ClientSession() as session:
-            unique_video_urls = set()
-            for urls in payload.video_blocks.values():
-                unique_video_urls.update(urls)
-            video_urls_list = list(unique_video_urls)
-
-            audio_urls = [url for urls in payload.audio_blocks.values() for url in urls]
-
-            v_tasks = [self._download_file(session, u) for u in video_urls_list]
-            a_tasks = [self._download_file(session, u) for u in audio_urls]
-            speech_tasks = [
-                _get_speech_audio(session, item.text, item.voice)
-                for item in payload.text_to_speech
+            tasks = [*normalized_clips.values(), *clip_durations.values()]
+            for task in (*tasks, *premixes.values()):
+                task.cancel()
+            for result in await asyncio.gather(
+                *normalized_clips.values(), return_exceptions=True
+            ):
+                if isinstance(result, CacheEntry):
+                    self._segment_cache.release(result)
+            for result in await asyncio.gather(
+                *clip_durations.values(), *premixes.values(), return_exceptions=True
+            ):
+                if isinstance(result, CacheEntry):
+                    self._premix_cache.release(result)
+            for entry in assets:
+                self._asset_cache.release(entry)
+            for entry in speech_entries:
+                self._eleven_labs_client.release(entry)
+
+    @staticmethod
+    def _unusable_parts(
+        parts: list[RenderPartSchema],
+        video_map: dict[str, CacheEntry | Exception],
+        audio_map: dict[str, CacheEntry | Exception],
+        speech_map: dict[tuple[str, str], str | Exception],
+    ) -> dict[int, Exception]:
+        """The first problem with the assets of each part that cannot be rendered"""
+        video_errors = {
+            url: entry
+            if isinstance(entry, Exception)
+            else InvalidMediaError(f"{url} has no video stream")
+            for url, entry in video_map.items()
+            if isinstance(entry, Exception) or not entry.meta["media"]["has_video"]
+        }
+        audio_errors = {
+            url: entry
+            if isinstance(entry, Exception)
+            else InvalidMediaError(f"{url} has no audio stream")
+            for url, entry in audio_map.items()
+            if isinstance(entry, Exception) or not entry.meta["media"]["has_audio"]
+        }
+        failed = {}
+        for part in parts:
+            errors = [
+                *(video_errors.get(str(url)) for url in part.video_urls),
+                audio_errors.get(str(part.audio_url)),
+                *(speech_map[(s.text, s.voice)] for s in part.speech),
             ]
+            error = next((e for e in errors if isinstance(e, Exception)), None)
+            if error is not None:
+                failed[part.index] = error
+        return failed
 
-            results = await asyncio.gather(*(v_tasks + a_tasks + speech_tasks))
+    async def _render_and_upload(
+        self,
+        task_id: str,
+        task_name: str,
+        parts: list[tuple[int, list, asyncio.Task]],
+        profile: EncodeProfile,
+        progress: BatchProgress,
+        on_uploaded: Callable[[int, str], Awaitable[None]],
+    ) -> dict[int, str | Exception]:
+        """Render parts on the pool and upload each one as soon as it is ready"""
+        queue_size = get_settings().UPLOAD_QUEUE_SIZE
+        upload_queue: asyncio.Queue[tuple[int, str]] = asyncio.Queue(queue_size)
+        # bounds rendered parts on disk; a full upload queue holds back new renders
+        scratch = asyncio.Semaphore(self._render_pool.budget + queue_size)
+        results: dict[int, str | Exception] = {}
+        renders: set[asyncio.Task] = set()
 
-            v_paths = results[: len(v_tasks)]
-            a_paths = results[len(v_tasks) :]
-            speech_paths = results[len(v_tasks) + len(a_tasks) :]
+        async def _render(index: int, clips, premix):
+            if get_settings().STREAM_UPLOADS:
+                try:
+                    results[index] = await self._stream_part(
+                        clips, premix, f"{task_name}_{index + 1}.mp4", profile, progress
+                    )
+                    progress.add("rendered")
+                    await on_uploaded(index, results[index])
+                except Exception as e:
+                    self._logger.error(f"Part {index} of {task_name} failed: {e}")
+                    results[index] = e
+                finally:
+                    scratch.release()
+                return
+            try:
+                path = await self._generate_part(
+                    task_id, index, clips, premix, profile, progress
+                )
+            except Exception as e:
+                self._logger.error(f"Part {index} of {task_name} failed: {e}")
+                results[index] = e
+                scratch.release()
+                return
+            progress.add("rendered")
+            # an interrupted part stays on disk, the next attempt uploads it
+            await upload_queue.put((index, path))
 
-            for url, path in zip(video_urls_list, v_paths):
-                video_map[url] = path
+        async def _upload():
+            while True:
+                index, path = await upload_queue.get()
+                try:
+                    results[index] = await self._google_drive_client.upload_file(
+                        path,
+                        f"{task_name}_{index + 1}.mp4",
+                        on_progress=lambda sent: progress.add("upload_bytes", sent),
+                        session_key=self._part_key(task_id, index),
+                    )
+                    os.remove(path)
+                    await on_uploaded(index, results[index])
+                except Exception as e:
+                    # the part is kept for a retry; discarded once it is final
+                    self._logger.error(f"Upload of part {index} of {task_name} failed: {e}")
+                    results[index] = e
+                finally:
+                    scratch.release()
+                    upload_queue.task_done()
 
-            temp_files.extend(v_paths + a_paths + speech_paths)
+        uploaders = [
+            asyncio.create_task(_upload())
+            for _ in range(get_settings().UPLOAD_CONCURRENCY)
+        ]
+        try:
+            for index, clips, premix in parts:
+                await scratch.acquire()
+                render = asyncio.create_task(_render(index, clips, premix))
+                renders.add(render)
+                render.add_done_callback(renders.discard)
+            await asyncio.gather(*renders)
+            await upload_queue.join()
+        finally:
+            for task in (*renders, *uploaders):
+                task.cancel()
+            await asyncio.gather(*renders, *uploaders, return_exceptions=True)
 
-            return video_map, a_paths, speech_paths, temp_files
+        return dict(sorted(results.items()))
+
+    async def _prepare_assets(
+        self,
+        video_urls: list[str],
+        audio_urls: list[str],
+        speech: list[tuple[str, str]],
+        progress: BatchProgress,
+    ):
+        """Fetch assets and speech, returning lookup maps, holding the error of
+        whatever could not be fetched, and the entries to release"""
+
+        async def _counted(fetch, field: str):
+            result = await fetch
+            progress.add(field)
+            return result
+
+        session = self._http_pool.session("downloads")
+        v_tasks = [
+            _counted(self._asset_cache.acquire(session, u), "downloaded")
+            for u in video_urls
+        ]
+        a_tasks = [
+            _counted(self._asset_cache.acquire(session, u), "downloaded")
+            for u in audio_urls
+        ]
+        speech_tasks = [
+            _counted(self._eleven_labs_client.get_speech_by_text(text, voice), "speech_done")
+            for text, voice in speech
+        ]
+        progress.set(downloads=len(v_tasks) + len(a_tasks), speech=len(speech_tasks))
+
+        results = await asyncio.gather(
+            *(v_tasks + a_tasks + speech_tasks), return_exceptions=True
+        )
+
+        v_entries = results[: len(v_tasks)]
+        a_entries = results[len(v_tasks) : len(v_tasks) + len(a_tasks)]
+        speech_entries = results[len(v_tasks) + len(a_tasks) :]
+
+        assets = [e for e in v_entries + a_entries if not isinstance(e, BaseException)]
+        speech_fetched = [e for e in speech_entries if not isinstance(e, BaseException)]
+        stopped = [
+            r for r in results
+            if isinstance(r, BaseException) and not isinstance(r, Exception)
+        ]
+        if stopped:
+            for entry in assets:
+                self._asset_cache.release(entry)
+            for entry in speech_fetched:
+                self._eleven_labs_client.release(entry)
+            raise stopped[0]
+
+        return (
+            dict(zip(video_urls, v_entries)),
+            dict(zip(audio_urls, a_entries)),
+            {
+                key: entry if isinstance(entry, Exception) else entry.path
+                for key, entry in zip(speech, speech_entries)
+            },
+            assets,
+            speech_fetched,
+        )
 
     @timer
-    async def _generate_part(
-        self, index: int, video_paths: list, audio_path: str, speech_path: list[str]
-    ) -> str:
-        part_filename = f"/tmp/part_{index}.mp4"
+    async def _normalize_clip(
+        self,
+        entry: CacheEntry,
+        profile: EncodeProfile,
+        clip_seconds: float | None,
+        progress: BatchProgress,
+    ) -> CacheEntry:
+        """Transcode a source clip to the uniform format parts are concatenated from,
+        once per source content and encode profile across jobs"""
+        source = entry.meta.get("sha256") or os.path.basename(entry.path)
+        params = profile.output_params()
+        key = hashlib.sha256(
+            json.dumps([source, params, clip_seconds], sort_keys=True).encode()
+        ).hexdigest()
+
+        async def _fill(path: str, _: CacheEntry | None) -> dict:
+            media = entry.meta["media"]
+            await self._render(
+                self._get_normalize_args(entry.path, path, profile, media, clip_seconds),
+                path,
+                # a stream copy barely uses the CPU
+                1 if self._is_conforming(media, profile) else profile.threads,
+                progress.encoder,
+            )
+            return {"source": source, "profile": params, "clip_seconds": clip_seconds}
+
+        return await self._segment_cache.acquire(key, _fill, suffix=".mp4")
 
-        process = await asyncio.create_subprocess_exec(
-            *self._get_part_args(video_paths, audio_path, speech_path, part_filename),
-            stdout=asyncio.subprocess.DEVNULL,
-            stderr=asyncio.subprocess.PIPE,
+    @staticmethod
+    async def _clip_duration(
+        entry: CacheEntry, clip: asyncio.Task, clip_seconds: float | None
+    ) -> float:
+        """Predicted from the metadata index; probes the normalized clip if unknown"""
+        if entry.meta["media"].get("duration"):
+            return min(entry.meta["media"]["duration"], clip_seconds or math.inf)
+        return probe.duration(await probe.probe((await asyncio.shield(clip)).path))
+
+    @timer
+    async def _premix_audio(
+        self,
+        audio_path: str,
+        speech_paths: list[str],
+        part_durations: list[list[asyncio.Task]],
+        profile: EncodeProfile,
+        progress: BatchProgress,
+    ) -> CacheEntry:
+        """Mix music and speech once for every part sharing them, cached by content"""
+        longest = max(
+            [sum([await asyncio.shield(d) for d in durations]) for durations in part_durations]
         )
+        # rounded up so parts of similar length share one cached track
+        length = max(1, math.ceil(longest / self.PREMIX_STEP)) * self.PREMIX_STEP
+        # cache file names embed a content version, so they identify the inputs
+        key = hashlib.sha256(
+            json.dumps(
+                [
+                    os.path.basename(audio_path),
+                    [os.path.basename(p) for p in speech_paths],
+                    length,
+                    profile.audio_bitrate,
+                    profile.sample_rate,
+                ]
+            ).encode()
+        ).hexdigest()
 
-        _, stderr = await process.communicate()
+        async def _fill(path: str, _: CacheEntry | None) -> dict:
+            async with self._concat_scripts(speech_paths) as (speech_concat_filename,):
+                await self._render(
+                    self._get_premix_args(
+                        audio_path,
+                        speech_concat_filename,
+                        path,
+                        length,
+                        profile,
+                    ),
+                    path,
+                    on_progress=progress.encoder,
+                )
+            return {"length": length}
 
-        if process.returncode != 0:
-            raise Exception(f"Failed to generate part {index}")
+        return await self._premix_cache.acquire(key, _fill, suffix=".m4a")
 
+    @timer
+    async def _generate_part(
+        self,
+        task_id: str,
+        index: int,
+        clips: list[asyncio.Task],
+        premix: asyncio.Task,
+        profile: EncodeProfile,
+        progress: BatchProgress,
+    ) -> str:
+        part_filename = self._part_path(task_id, index)
+        if os.path.exists(part_filename):
+            # rendered by an attempt that was interrupted before the upload finished
+            return part_filename
+        video_paths = [(await asyncio.shield(clip)).path for clip in clips]
+        audio = await asyncio.shield(premix)
+        os.makedirs(get_settings().PARTS_DIR, exist_ok=True)
+        # renamed once complete, so a kept part is never a truncated one
+        rendering = f"{part_filename}.rendering"
+        async with self._concat_scripts(video_paths) as (video_concat_filename,):
+            await self._render(
+                self._get_part_args(
+                    video_concat_filename, audio.path, rendering, profile
+                ),
+                rendering,
+                on_progress=progress.encoder,
+            )
+        os.replace(rendering, part_filename)
         return part_filename
 
     @timer
-    async def _stitch_and_upload(self, part_files: list, task_name: str):
-        for index, part_file in enumerate(part_files):
-            file_name = f"{task_name}_{index + 1}.mp4"
-            upload_url = await self._google_drive_client.upload_file_in_stream(
-                filename=file_name, mime_type="video/mp4"
-            )
-
-            file_size = os.path.getsize(part_file)
-            offset = 0
-
-            with open(part_file, "rb") as f:
-                while True:
-                    chunk = f.read(FILE_CHUNK_SIZE)
-                    if not chunk:
-                        break
-
-                    chunk_len = len(chunk)
-                    await self._google_drive_client.upload_chunk(
-                        upload_url,
-                        chunk,
-                        offset,
-                        offset + chunk_len - 1,
-                        file_size,
-                    )
-                    offset += chunk_len
+    async def _stream_part(
+        self,
+        clips: list[asyncio.Task],
+        premix: asyncio.Task,
+        file_name: str,
+        profile: EncodeProfile,
+        progress: BatchProgress,
+    ) -> str:
+        """Render a part straight into a Drive upload without a temporary file"""
+        video_paths = [(await asyncio.shield(clip)).path for clip in clips]
+        audio = await asyncio.shield(premix)
+        async with self._concat_scripts(video_paths) as (video_concat_filename,):
+            return await self._render_pool.stream(
+                self._get_part_args(
+                    video_concat_filename, audio.path, "pipe:1", profile
+                ),
+                lambda stdout, finished: self._google_drive_client.upload_stream(
+                    stdout,
+                    file_name,
+                    before_finalize=finished,
+                    on_progress=lambda sent: progress.add("upload_bytes", sent),
+                ),
+                on_progress=progress.encoder,
+            )
 
-    @staticmethod
-    async def _download_file(session: aiohttp.ClientSession, url: str) -> str:
-        ext = os.path.splitext(str(url))[1].split("?")[0] or ".mp4"
-        filename = f"/tmp/{uuid.uuid4()}{ext}"
+    @asynccontextmanager
+    async def _concat_scripts(self, *path_lists: list[str]):
+        filenames = []
         try:
-            async with session.get(str(url), timeout=60) as resp:
-                if resp.status != 200:
-                    raise Exception(f"Download failed {resp.status}: {url}")
-                with open(filename, "wb") as f:
-                    while True:
-                        chunk = await resp.content.read(FILE_CHUNK_SIZE)
-                        if not chunk:
-                            break
-                        f.write(chunk)
-            return filename
-        except Exception as e:
-            if os.path.exists(filename):
-                os.remove(filename)
-            raise e
+            for paths in path_lists:
+                filename = f"/tmp/{uuid.uuid4()}_concat.txt"
+                filenames.append(filename)
+                async with aopen(filename, "w") as f:
+                    await f.write(self._get_concat_list(paths))
+            yield filenames
+        finally:
+            for filename in filenames:
+                try:
+                    await run_io(os.remove, filename)
+                except FileNotFoundError:
+                    pass
 
-    @staticmethod
-    def _get_part_args(
-        video_paths: list, audio_path: str, speech_path: list[str], output_filename: str
+    async def _render(
+        self,
+        args: list[str],
+        output_filename: str,
+        threads: int = 1,
+        on_progress: ProgressCallback | None = None,
     ):
-        v_streams = [
-            ffmpeg.input(path).video.filter("scale", 720, 1280).filter("fps", 30)
-            for path in video_paths
-        ]
+        try:
+            await self._render_pool.run(args, threads, on_progress)
+        except BaseException:
+            if os.path.exists(output_filename):
+                os.remove(output_filename)
+            raise
 
-        if len(v_streams) > 1:
-            v = ffmpeg.concat(*v_streams, v=1, a=0).node[0]
+    @classmethod
+    def _get_normalize_args(
+        cls,
+        input_filename: str,
+        output_filename: str,
+        profile: EncodeProfile,
+        media: dict,
+        clip_seconds: float | None = None,
+    ):
+        # limiting the input keeps ffmpeg from decoding the rest of the clip
+        source = ffmpeg.input(input_filename, **({"t": clip_seconds} if clip_seconds else {}))
+        if cls._is_conforming(media, profile):
+            # already what the encoder would produce: only drop audio and retime
+            return (
+                ffmpeg.output(
+                    source.video,
+                    output_filename,
+                    format="mp4",
+                    vcodec="copy",
+                    video_track_timescale=cls.VIDEO_TIMESCALE,
+                    metadata=f"comment={profile.stamp()}",
+                )
+                .overwrite_output()
+                .compile()
+            )
+
+        v = source.video
+        scale = media.get("width") != profile.width or media.get("height") != profile.height
+        if scale:
+            v = v.filter("scale", profile.width, profile.height)
+        if scale or not probe.has_square_pixels(media):
+            v = v.filter("setsar", 1)
+        if media.get("fps") is None or abs(media["fps"] - profile.fps) >= 0.01:
+            v = v.filter("fps", profile.fps)
+        if profile.crf is not None:
+            rate = {"crf": profile.crf}
         else:
-            v = v_streams[0]
+            rate = {"video_bitrate": profile.video_bitrate}
+        return (
+            ffmpeg.output(
+                v,
+                output_filename,
+                format="mp4",
+                vcodec="libx264",
+                preset=profile.preset,
+                pix_fmt="yuv420p",
+                video_track_timescale=cls.VIDEO_TIMESCALE,
+                threads=profile.threads,
+                metadata=f"comment={profile.stamp()}",
+                **rate,
+            )
+            .overwrite_output()
+            .compile()
+        )
+
+    @staticmethod
+    def _is_conforming(media: dict, profile: EncodeProfile) -> bool:
+        """Whether a clip can be concatenated by stream copy with the encoded ones"""
+        # concat copies one avcC (SPS/PPS) for the whole output, which only
+        # matches for clips this service encoded itself with the same settings;
+        # other encoders differ in level, refs or frame numbering
+        return (
+            media.get("comment") == profile.stamp()
+            and media.get("vcodec") == "h264"
+            and media.get("profile") == profile.h264_profile
+            and media.get("pix_fmt") == "yuv420p"
+            and probe.matches_geometry(media, profile.width, profile.height, profile.fps)
+        )
+
+    @staticmethod
+    def _get_concat_list(paths: list[str]) -> str:
+        """Build a concat demuxer script, which unlike concat filter inputs may repeat a file"""
+        lines = []
+        for path in paths:
+            escaped = path.replace("'", "'\\''")
+            lines.append(f"file '{escaped}'")
+        return "\n".join(lines) + "\n"
 
+    @staticmethod
+    def _get_premix_args(
+        audio_path: str,
+        speech_concat_filename: str,
+        output_filename: str,
+        length: int,
+        profile: EncodeProfile,
+    ):
         video_audio = ffmpeg.input(audio_path, stream_loop=-1).audio.filter(
             "volume", 0.1
         )
-        speech_inputs = [ffmpeg.input(speech).audio for speech in speech_path]
-        if len(speech_inputs) > 1:
-            combined_speech = ffmpeg.concat(*speech_inputs, v=0, a=1)
-        else:
-            combined_speech = speech_inputs[0]
-
-        combined_speech = combined_speech.filter("volume", 1.5)
+        combined_speech = (
+            ffmpeg.input(speech_concat_filename, format="concat", safe=0)
+            .audio.filter("volume", 1.5)
+        )
 
         merged_audio = ffmpeg.filter(
             [video_audio, combined_speech], "amix", inputs=2, duration="longest"
         )
         return (
             ffmpeg.output(
-                v,
                 merged_audio,
                 output_filename,
                 format="mp4",
-                vcodec="libx264",
-                preset="ultrafast",
                 acodec="aac",
-                ar=44100,
-                video_bitrate="2M",
-                pix_fmt="yuv420p",
-                shortest=None,
-                movflags="frag_keyframe+empty_moov",
+                audio_bitrate=profile.audio_bitrate,
+                ar=profile.sample_rate,
+                t=length,
             )
             .overwrite_output()
             .compile()
         )
 
     @staticmethod
-    async def _read_exact_chunk(stream, size):
-        try:
-            return await stream.readexactly(size)
-        except asyncio.IncompleteReadError as e:
-            return e.partial
+    def _get_part_args(
+        video_concat_filename: str,
+        premix_path: str,
+        output_filename: str,
+        profile: EncodeProfile,
+    ):
+        v = ffmpeg.input(video_concat_filename, format="concat", safe=0).video
+        a = ffmpeg.input(premix_path).audio
+        return (
+            ffmpeg.output(
+                v,
+                a,
+                output_filename,
+                format="mp4",
+                vcodec="copy",
+                acodec="copy",
+                shortest=None,
+                movflags="frag_keyframe+empty_moov",
+                # parts are made of the profile's segments, they can be reused as clips
+                metadata=f"comment={profile.stamp()}",
+            )
+            .overwrite_output()
+            .compile()
+        )
@@ -1,4 +1,6 @@
-from fastapi import APIRouter, Depends, status, Request
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Header, Request, Response, status
 
 from image_processor.limiter import limiter
 from image_processor.media.schema import CreateMediaSchema
@@ -17,8 +19,13 @@ router = APIRouter(
 @limiter.limit("2/minute")
 async def create_media(
     request: Request,
+    response: Response,
     media_payload: CreateMediaSchema,
+    idempotency_key: Annotated[str | None, Header(max_length=255)] = None,
     media_service: MediaService = Depends(ServiceProvider.get_media_service),
 ):
-    await media_service.save_file(media_payload)
-    return {"status": "uploaded"}
+    result = await media_service.save_file(media_payload, idempotency_key)
+    if result["status"] == "duplicate":
+        # nothing new was created, the existing job is returned
+        response.status_code = status.HTTP_200_OK
+    return result
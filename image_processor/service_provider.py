@@ -2,9 +2,15 @@ import logging
 
 from image_processor.broker import Broker
 from image_processor.config import get_settings
+from image_processor.core.disk_cache import DiskCache
+from image_processor.core.http_pool import HttpPool
+from image_processor.core.loop_monitor import LoopLagMonitor
 from image_processor.google_clients.google_drive_client import GoogleDriveClient
+from image_processor.media.asset_cache import AssetCache
 from image_processor.media.elevenlabs_client import ElevenLabsClient
+from image_processor.media.render_pool import RenderPool
 from image_processor.media.service import MediaService
+from image_processor.tasks.store import TaskStore
 from image_processor.settings.logging import configure_logging
 
 logging.config.dictConfig(configure_logging(get_settings()))
@@ -16,14 +22,71 @@ class ServiceProvider:
     rabbitmq_broker: Broker
     logger: logging.Logger
     eleven_labs_client: ElevenLabsClient
+    # render pool and caches only exist in processes that consume jobs
+    render_pool: RenderPool | None
+    asset_cache: AssetCache | None
+    loop_monitor: LoopLagMonitor
+    http_pool: HttpPool
+    task_store: TaskStore
+    premix_cache: DiskCache | None
+    segment_cache: DiskCache | None
+    worker: bool
 
-    def __init__(self):
+    def __init__(self, worker: bool = True):
         cls = self.__class__
+        cls.worker = worker
         cls.logger = logging.getLogger(__name__)
-        cls.google_drive_client = GoogleDriveClient("token.json", cls.logger)
-        cls.eleven_labs_client = ElevenLabsClient(cls.logger)
+        cls.loop_monitor = LoopLagMonitor(cls.logger)
+        cls.http_pool = HttpPool(cls.logger)
+        cls.google_drive_client = GoogleDriveClient(
+            "token.json", cls.logger, cls.http_pool
+        )
+        cls.eleven_labs_client = ElevenLabsClient(
+            cls.logger,
+            DiskCache(
+                "speech",
+                get_settings().SPEECH_CACHE_DIR,
+                get_settings().SPEECH_CACHE_MAX_BYTES,
+                cls.logger,
+                max_age=get_settings().SPEECH_CACHE_MAX_AGE,
+            )
+            if worker
+            else None,
+            cls.http_pool,
+        )
+        cls.task_store = TaskStore(
+            get_settings().TASKS_DIR, get_settings().TASK_RECORD_MAX_AGE, cls.logger
+        )
+        cls.render_pool = cls.asset_cache = cls.premix_cache = cls.segment_cache = None
+        if worker:
+            cls.render_pool = RenderPool(cls.logger, threads=get_settings().RENDER_THREADS)
+            cls.asset_cache = AssetCache(
+                get_settings().ASSET_CACHE_DIR,
+                get_settings().ASSET_CACHE_MAX_BYTES,
+                get_settings().ASSET_CACHE_REVALIDATE_AFTER,
+                cls.logger,
+            )
+            cls.premix_cache = DiskCache(
+                "premix",
+                get_settings().PREMIX_CACHE_DIR,
+                get_settings().PREMIX_CACHE_MAX_BYTES,
+                cls.logger,
+            )
+            cls.segment_cache = DiskCache(
+                "segments",
+                get_settings().SEGMENT_CACHE_DIR,
+                get_settings().SEGMENT_CACHE_MAX_BYTES,
+                cls.logger,
+            )
         cls.rabbitmq_broker = cls._get_broker()
         cls.media_service = cls._get_media_service()
+        # a 401 seen by any process makes every process check the credentials again
+        cls.google_drive_client.validation.on_invalidate = (
+            lambda: cls.media_service.report_unauthorized("google_drive")
+        )
+        cls.eleven_labs_client.validation.on_invalidate = (
+            lambda: cls.media_service.report_unauthorized("eleven_labs")
+        )
 
     @classmethod
     def _get_broker(cls) -> Broker:
@@ -40,8 +103,36 @@ class ServiceProvider:
             cls.rabbitmq_broker,
             cls.logger,
             cls.eleven_labs_client,
+            cls.render_pool,
+            cls.asset_cache,
+            cls.http_pool,
+            cls.task_store,
+            cls.premix_cache,
+            cls.segment_cache,
         )
 
+    @classmethod
+    def get_metrics(cls) -> dict:
+        """Stats of this process; workers log theirs every WORKER_STATS_INTERVAL"""
+        metrics = {
+            "event_loop": cls.loop_monitor.stats(),
+            "http_pool": cls.http_pool.stats(),
+        }
+        if cls.worker:
+            metrics.update(
+                asset_cache=cls.asset_cache.stats(),
+                speech_cache=cls.eleven_labs_client.cache_stats(),
+                premix_cache=cls.premix_cache.stats(),
+                render_pool=cls.render_pool.stats(),
+                segment_cache=cls.segment_cache.stats(),
+                speech_rate_limiter=cls.eleven_labs_client.limiter_stats(),
+                drive_uploads=cls.google_drive_client.upload_stats(),
+            )
+        return metrics
+
     async def shutdown(self):
+        await self.loop_monitor.stop()
         await self.rabbitmq_broker.close()
-        await self.google_drive_client.shutdown()
+        if self.render_pool is not None:
+            await self.render_pool.close()
+        await self.http_pool.close()
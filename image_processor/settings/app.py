@@ -27,3 +27,106 @@ class AppSettings(BaseSettings):
     RABBITMQ_QUEUE_NAME: str = os.getenv("RABBITMQ_QUEUE_NAME")
 
     ELEVENLABS_API_KEY: str = os.getenv("ELEVENLABS_API_KEY")
+    ELEVENLABS_CONCURRENCY: int = 2
+    ELEVENLABS_MAX_CONCURRENCY: int = 8
+    ELEVENLABS_MAX_RETRIES: int = 5
+
+    # standalone consumer processes started by `python -m image_processor.worker`
+    WORKER_PROCESSES: int = 1
+    # unacknowledged jobs each worker process handles concurrently
+    WORKER_PREFETCH: int = 1
+    # how long SIGTERM waits for running jobs before they are requeued
+    WORKER_DRAIN_TIMEOUT: int = 600  # seconds
+    # also consume inside the API process, for single-container setups; the
+    # API process only builds render pool and caches when this is set
+    EMBEDDED_WORKER: bool = False
+    # how often worker processes log their metrics
+    WORKER_STATS_INTERVAL: int = 60  # seconds
+
+    # jobs producing more videos are rejected; use max_outputs to sample
+    MAX_OUTPUTS_PER_TASK: int = 1000
+    # parts per sub-task message a job is split into; each batch downloads
+    # and normalizes its clips once, smaller batches spread across more workers
+    RENDER_BATCH_SIZE: int = 4
+    # job records shared by the API and all workers; they must run on one host
+    # with this on a local volume, updates rely on flock which NFS does not honour.
+    # Jobs and batches whose record is missing here are dead-lettered unrendered
+    TASKS_DIR: str = "/var/cache/image_processor/tasks"
+    TASK_RECORD_MAX_AGE: int = 7 * 24 * 60 * 60  # seconds
+
+    # jobs are published with a priority from their estimated cost so short
+    # jobs overtake long ones; 0 disables priorities. The job and parts queues
+    # are then named <queue>.p<N>, old queues are drained and can be deleted
+    QUEUE_MAX_PRIORITY: int = 10
+    # seconds of media the workers together get through per second, for ETAs
+    RENDER_THROUGHPUT: float = 20
+    # new jobs are refused with 503 while the backlog ETA exceeds this; 0 disables
+    ADMISSION_MAX_BACKLOG: int = 2 * 60 * 60  # seconds
+    # queued or running records not updated for this long no longer count as backlog
+    ADMISSION_STALE_AFTER: int = 24 * 60 * 60  # seconds
+    # a resubmitted job attaches to the same queued or running one, and gets the
+    # files of one finished within this window instead of being rendered again
+    DEDUP_WINDOW: int = 24 * 60 * 60  # seconds
+
+    # failed jobs and batches are retried after RETRY_BASE_DELAY * 2^n seconds,
+    # then moved to <queue>.dead; parts that were uploaded are not redone
+    RETRY_MAX_ATTEMPTS: int = 5
+    RETRY_BASE_DELAY: int = 10  # seconds
+
+    # how often a render batch writes its progress to the job record
+    PROGRESS_INTERVAL: float = 2  # seconds
+
+    # distinct (music, speech order) pairs per job, each pre-mixed only once
+    AUDIO_VARIANTS: int = 8
+
+    # CPU threads concurrent ffmpeg processes may use in total, each encode
+    # takes its profile's thread count; 0 means all CPUs available to the process
+    RENDER_THREADS: int = 0
+    # encode profile (draft, standard, high) for jobs that do not choose one
+    DEFAULT_ENCODE_PROFILE: str = "standard"
+
+    # preview jobs: sampled combinations, their profile and the seconds of
+    # each clip they use; rendered by one worker from the <queue>.preview queue
+    PREVIEW_OUTPUTS: int = 3
+    PREVIEW_PROFILE: str = "preview"
+    PREVIEW_CLIP_SECONDS: float = 3
+    # rendered parts waiting for upload before rendering is held back
+    UPLOAD_QUEUE_SIZE: int = 2
+    # pipe ffmpeg output straight into the Drive upload instead of /tmp
+    STREAM_UPLOADS: bool = False
+    # concurrent resumable upload sessions per process
+    UPLOAD_CONCURRENCY: int = 3
+    UPLOAD_MAX_CHUNK_SIZE: int = 32 * 1024 * 1024  # 32 MB
+    UPLOAD_MAX_RETRIES: int = 5
+    UPLOAD_SESSIONS_DIR: str = "/var/cache/image_processor/upload_sessions"
+    # rendered parts are kept here until Drive has them, so a part interrupted
+    # by a restart is uploaded from where it stopped instead of rendered again
+    PARTS_DIR: str = "/var/cache/image_processor/parts"
+
+    # how long a successful Drive/ElevenLabs credential check is trusted
+    VALIDATION_CACHE_TTL: int = 300  # seconds
+    VALIDATION_REFRESH_AHEAD: int = 60  # seconds
+
+    # shared keep-alive pools for Drive, ElevenLabs and asset downloads
+    HTTP_POOL_LIMIT: int = 100
+    HTTP_POOL_LIMIT_PER_HOST: int = 16
+    HTTP_KEEPALIVE_TIMEOUT: int = 30  # seconds
+    HTTP_DNS_CACHE_TTL: int = 300  # seconds
+    HTTP_CONNECT_TIMEOUT: int = 10  # seconds
+    HTTP_READ_TIMEOUT: int = 60  # seconds
+
+    # each process caches in its own slot-N subdirectory of these, so the
+    # byte budgets below apply per worker process
+    ASSET_CACHE_DIR: str = "/var/cache/image_processor/assets"
+    ASSET_CACHE_MAX_BYTES: int = 2 * 1024 * 1024 * 1024  # 2 GB
+    ASSET_CACHE_REVALIDATE_AFTER: int = 300  # seconds
+
+    SEGMENT_CACHE_DIR: str = "/var/cache/image_processor/segments"
+    SEGMENT_CACHE_MAX_BYTES: int = 4 * 1024 * 1024 * 1024  # 4 GB
+
+    PREMIX_CACHE_DIR: str = "/var/cache/image_processor/premix"
+    PREMIX_CACHE_MAX_BYTES: int = 512 * 1024 * 1024  # 512 MB
+
+    SPEECH_CACHE_DIR: str = "/var/cache/image_processor/speech"
+    SPEECH_CACHE_MAX_BYTES: int = 512 * 1024 * 1024  # 512 MB
+    SPEECH_CACHE_MAX_AGE: int = 7 * 24 * 60 * 60  # seconds
@@ -7,3 +7,5 @@ class LocalAppSettings(AppSettings):
     debug: bool = True
 
     logging_level: int = logging.DEBUG
+
+    DEFAULT_ENCODE_PROFILE: str = "draft"
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import time
+
+from image_processor.tasks.store import TaskStore
+
+
+class BatchProgress:
+    """Stage counters of one render batch, written to its job record periodically"""
+
+    def __init__(
+        self,
+        task_store: TaskStore,
+        task_id: str,
+        key: str,
+        parts: int,
+        interval: float,
+        logger: logging.Logger,
+    ):
+        self._task_store = task_store
+        self._task_id = task_id
+        self._key = key
+        self._interval = interval
+        self._logger = logger
+        self._state = {
+            "stage": "download",
+            "parts": parts,
+            "downloads": 0,
+            "downloaded": 0,
+            "speech": 0,
+            "speech_done": 0,
+            "rendered": 0,
+            "upload_bytes": 0,
+            "speed": None,
+            "fps": None,
+            "started_at": time.time(),
+        }
+        self._dirty = True
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self, stage: str = "done"):
+        self.set(stage=stage)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self._flush()
+
+    def set(self, **fields):
+        self._state.update(fields)
+        self._dirty = True
+
+    def add(self, field: str, amount: int = 1):
+        self._state[field] += amount
+        self._dirty = True
+
+    def encoder(self, progress: dict[str, str]):
+        """Record speed and fps from one ffmpeg `-progress` block"""
+        speed = progress.get("speed", "").rstrip("x")
+        fps = progress.get("fps")
+        try:
+            self._state["speed"] = float(speed)
+        except ValueError:
+            pass
+        try:
+            self._state["fps"] = float(fps)
+        except (TypeError, ValueError):
+            pass
+        self._dirty = True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            await self._flush()
+
+    async def _flush(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        try:
+            await self._task_store.update_batch(
+                self._task_id, self._key, {**self._state, "updated_at": time.time()}
+            )
+        except Exception as e:
+            self._logger.warning(f"Failed to record progress of {self._task_id}: {e}")
+
+
+def summarize(record: dict, throughput: float) -> dict:
+    """Job status with per-stage counts over all batches and a completion estimate"""
+    batches = list(record.get("batches", {}).values())
+    parts = record["parts"]
+    done = len(parts)
+    total = record["total"]
+    uploaded = sum(1 for p in parts.values() if p["file_id"])
+    now = time.time()
+    started_at = record.get("started_at")
+    elapsed = now - (started_at or record["created_at"])
+
+    if record["status"] not in (TaskStore.QUEUED, TaskStore.RUNNING):
+        eta = 0
+    elif done and started_at:
+        eta = elapsed / done * (total - done)
+    elif record.get("cost"):
+        # no part finished yet, fall back to the estimate made at submission
+        eta = max(0.0, record["cost"] / throughput - elapsed)
+    else:
+        eta = None
+
+    encoding = [b for b in batches if b["stage"] == "render" and b["speed"]]
+    return {
+        "task_id": record["task_id"],
+        "task_name": record["task_name"],
+        "status": record["status"],
+        "total": total,
+        "completed": done,
+        "uploaded": uploaded,
+        "failed": done - uploaded,
+        "stages": {
+            "download": {
+                "done": sum(b["downloaded"] for b in batches),
+                "total": sum(b["downloads"] for b in batches),
+            },
+            "speech": {
+                "done": sum(b["speech_done"] for b in batches),
+                "total": sum(b["speech"] for b in batches),
+            },
+            "render": {"done": sum(b["rendered"] for b in batches), "total": total},
+            "upload": {
+                "done": uploaded,
+                "total": total,
+                "bytes": sum(b["upload_bytes"] for b in batches),
+            },
+        },
+        "batches": {
+            "started": len(batches),
+            "active": sum(1 for b in batches if b["stage"] not in ("done", "cancelled")),
+        },
+        "encode": {
+            "speed": sum(b["speed"] for b in encoding) / len(encoding) if encoding else None,
+            "fps": sum(b["fps"] or 0 for b in encoding) if encoding else None,
+        },
+        "elapsed": round(elapsed, 1),
+        "eta": round(eta) if eta is not None else None,
+        "file_ids": [
+            parts[i]["file_id"] for i in sorted(parts, key=int) if parts[i]["file_id"]
+        ],
+    }
@@ -0,0 +1,293 @@
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from image_processor.core.async_io import run_io
+
+
+class TaskStore:
+    """Job records shared by every process on one host through a common directory.
+
+    Updates are serialized with fcntl.flock, which network filesystems such as
+    NFS do not reliably honour, so the directory must be on a local disk.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    # remaining cost and last update of every queued or running job, kept
+    # current on each write so the backlog is known without reading records
+    BACKLOG = "backlog"
+    # old records are removed on a create at most this often, as it lists the directory
+    PRUNE_INTERVAL = 60 * 60  # seconds
+
+    def __init__(self, directory: str, max_age: float, logger: logging.Logger):
+        self._directory = directory
+        self._max_age = max_age
+        self._logger = logger
+        self._pruned_at = 0.0
+        os.makedirs(self._directory, exist_ok=True)
+
+    async def create(
+        self, task_id: str, task_name: str, total: int, **fields
+    ) -> dict:
+        """Create the record, or return the existing one for a redelivered job"""
+        return await run_io(self._create, task_id, task_name, total, fields)
+
+    async def find(self, key: str, stale_after: float, reuse_within: float) -> dict | None:
+        """Return the live or recently finished task submitted under key"""
+        return await run_io(self._find, key, stale_after, reuse_within)
+
+    async def claim(
+        self,
+        key: str,
+        stale_after: float,
+        reuse_within: float,
+        task_id: str,
+        task_name: str,
+        total: int,
+        **fields,
+    ) -> tuple[dict, bool]:
+        """Like find, but create the task under key when there is none, atomically"""
+        return await run_io(
+            self._claim, key, stale_after, reuse_within, task_id, task_name, total, fields
+        )
+
+    async def update(self, task_id: str, **fields) -> dict | None:
+        return await run_io(self._update, task_id, fields)
+
+    async def start(self, task_id: str, **fields) -> dict | None:
+        """Move a queued task to running with fields, unless it was stopped meanwhile"""
+        return await run_io(self._start, task_id, fields)
+
+    async def get(self, task_id: str) -> dict | None:
+        return await run_io(self._read, task_id)
+
+    async def complete_parts(
+        self, task_id: str, results: dict[int, str | Exception]
+    ) -> dict | None:
+        """Record part results, returning the record if they completed the task"""
+        return await run_io(self._complete_parts, task_id, results)
+
+    async def cancel(self, task_id: str) -> dict | None:
+        """Mark a queued or running task cancelled, returning its record"""
+        return await run_io(self._cancel, task_id)
+
+    async def update_batch(self, task_id: str, key: str, state: dict):
+        """Store the progress of one render batch of the task"""
+        await run_io(self._update_batch, task_id, key, state)
+
+    async def backlog(self, stale_after: float) -> float:
+        """Estimated cost of the work left in queued and running jobs"""
+        return await run_io(self._backlog, stale_after)
+
+    def _create(self, task_id: str, task_name: str, total: int, fields: dict) -> dict:
+        now = time.time()
+        if now - self._pruned_at >= self.PRUNE_INTERVAL:
+            self._pruned_at = now
+            self._prune()
+        record = {
+            "task_id": task_id,
+            "task_name": task_name,
+            "status": self.RUNNING,
+            "total": total,
+            "created_at": now,
+            "updated_at": now,
+            "parts": {},
+            **fields,
+        }
+        with self._locked(task_id):
+            existing = self._read(task_id)
+            if existing is not None:
+                return existing
+            self._write(record)
+        return record
+
+    def _find(self, key: str, stale_after: float, reuse_within: float) -> dict | None:
+        try:
+            with open(self._key_path(key), "r") as f:
+                record = self._read(f.read())
+        except OSError:
+            return None
+        if record is None:
+            return None
+        now = time.time()
+        if record["status"] in (self.QUEUED, self.RUNNING):
+            # a job lost without finishing must not swallow resubmissions forever
+            return record if record["updated_at"] >= now - stale_after else None
+        if record["status"] == self.FINISHED:
+            return record if record["updated_at"] >= now - reuse_within else None
+        return None
+
+    def _claim(
+        self,
+        key: str,
+        stale_after: float,
+        reuse_within: float,
+        task_id: str,
+        task_name: str,
+        total: int,
+        fields: dict,
+    ) -> tuple[dict, bool]:
+        # keys are hex digests, longer than task ids, so their locks never clash
+        with self._locked(key):
+            record = self._find(key, stale_after, reuse_within)
+            if record is not None:
+                return record, False
+            record = self._create(task_id, task_name, total, fields)
+            tmp_path = f"{self._key_path(key)}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(task_id)
+            os.replace(tmp_path, self._key_path(key))
+        return record, True
+
+    def _update(self, task_id: str, fields: dict) -> dict | None:
+        with self._locked(task_id):
+            record = self._read(task_id)
+            if record is None:
+                return None
+            record.update(fields, updated_at=time.time())
+            self._write(record)
+        return record
+
+    def _start(self, task_id: str, fields: dict) -> dict | None:
+        with self._locked(task_id):
+            record = self._read(task_id)
+            if record is None or record["status"] not in (self.QUEUED, self.RUNNING):
+                return record
+            if record["status"] == self.QUEUED:
+                record.update(status=self.RUNNING, started_at=time.time())
+            record.update(fields, updated_at=time.time())
+            self._write(record)
+        return record
+
+    def _cancel(self, task_id: str) -> dict | None:
+        with self._locked(task_id):
+            record = self._read(task_id)
+            if record is None or record["status"] not in (self.QUEUED, self.RUNNING):
+                return record
+            record.update(status=self.CANCELLED, updated_at=time.time())
+            self._write(record)
+        return record
+
+    def _update_batch(self, task_id: str, key: str, state: dict):
+        with self._locked(task_id):
+            record = self._read(task_id)
+            if record is None:
+                return
+            record.setdefault("batches", {})[key] = state
+            self._write(record)
+
+    def _complete_parts(
+        self, task_id: str, results: dict[int, str | Exception]
+    ) -> dict | None:
+        with self._locked(task_id):
+            record = self._read(task_id)
+            if record is None:
+                self._logger.warning(f"Results for unknown task {task_id}")
+                return None
+            for index, result in results.items():
+                part = record["parts"].get(str(index), {})
+                if part.get("file_id"):
+                    # a redelivered batch must not overwrite an upload
+                    continue
+                if isinstance(result, Exception):
+                    record["parts"][str(index)] = {"file_id": None, "error": str(result)}
+                else:
+                    record["parts"][str(index)] = {"file_id": result, "error": None}
+            record["updated_at"] = time.time()
+            completed = (
+                record["status"] == self.RUNNING
+                and len(record["parts"]) >= record["total"]
+            )
+            if completed:
+                uploaded = any(p["file_id"] for p in record["parts"].values())
+                record["status"] = self.FINISHED if uploaded else self.FAILED
+            self._write(record)
+        return record if completed else None
+
+    def _backlog(self, stale_after: float) -> float:
+        cutoff = time.time() - stale_after
+        # jobs lost without finishing stop counting eventually
+        return sum(
+            remaining
+            for remaining, updated_at in self._read_backlog().values()
+            if updated_at >= cutoff
+        )
+
+    def _track(self, record: dict):
+        """Bring the record's entry in the backlog index up to date"""
+        entry = None
+        if record["status"] in (self.QUEUED, self.RUNNING):
+            done = len(record["parts"]) / record["total"] if record["total"] else 0
+            remaining = record.get("cost", 0) * (1 - min(done, 1))
+            entry = [remaining, record["updated_at"]]
+        with self._locked(self.BACKLOG):
+            backlog = self._read_backlog()
+            if backlog.get(record["task_id"]) == entry:
+                return
+            if entry is None:
+                del backlog[record["task_id"]]
+            else:
+                backlog[record["task_id"]] = entry
+            cutoff = time.time() - self._max_age
+            backlog = {k: v for k, v in backlog.items() if v[1] >= cutoff}
+            tmp_path = f"{self._backlog_path()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(backlog, f)
+            os.replace(tmp_path, self._backlog_path())
+
+    def _read_backlog(self) -> dict[str, list[float]]:
+        try:
+            with open(self._backlog_path(), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _read(self, task_id: str) -> dict | None:
+        try:
+            with open(self._path(task_id), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, record: dict):
+        tmp_path = f"{self._path(record['task_id'])}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, self._path(record["task_id"]))
+        self._track(record)
+
+    @contextmanager
+    def _locked(self, task_id: str):
+        # serializes updates from every worker process sharing TASKS_DIR
+        with open(f"{self._path(task_id)}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _prune(self):
+        cutoff = time.time() - self._max_age
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _path(self, task_id: str) -> str:
+        return os.path.join(self._directory, f"{task_id}.json")
+
+    def _key_path(self, key: str) -> str:
+        return os.path.join(self._directory, f"{key}.key")
+
+    def _backlog_path(self) -> str:
+        return os.path.join(self._directory, f"{self.BACKLOG}.index")
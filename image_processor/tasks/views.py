@@ -0,0 +1,30 @@
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Path, status
+
+from image_processor.media.service import MediaService
+from image_processor.service_provider import ServiceProvider
+
+router = APIRouter(
+    tags=["tasks"],
+)
+
+# task ids are uuid4 hex strings, see MediaService.save_file
+TaskId = Annotated[str, Path(pattern=r"^[0-9a-f]{32}$")]
+
+
+@router.get("/tasks/{task_id}")
+async def get_task(
+    task_id: TaskId,
+    media_service: MediaService = Depends(ServiceProvider.get_media_service),
+):
+    return await media_service.get_task_status(task_id)
+
+
+@router.delete("/tasks/{task_id}", status_code=status.HTTP_202_ACCEPTED)
+async def cancel_task(
+    task_id: TaskId,
+    media_service: MediaService = Depends(ServiceProvider.get_media_service),
+):
+    await media_service.cancel_task(task_id)
+    return {"status": "cancelled", "task_id": task_id}
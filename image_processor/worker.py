@@ -0,0 +1,105 @@
+import asyncio
+import json
+import logging
+import logging.config
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.connection import wait
+
+from image_processor.config import get_settings
+from image_processor.media.render_pool import available_cpus
+from image_processor.service_provider import ServiceProvider
+
+logger = logging.getLogger(__name__)
+
+
+async def log_metrics(index: int, stop: asyncio.Event):
+    """Log this process's cache, render pool and upload stats, which /metrics can't see"""
+    interval = get_settings().WORKER_STATS_INTERVAL
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except TimeoutError:
+            logger.info(f"Worker {index} metrics: {json.dumps(ServiceProvider.get_metrics())}")
+
+
+async def serve(index: int):
+    """Consume the task queue in this process until SIGTERM, then drain"""
+    service_provider = ServiceProvider()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    service_provider.loop_monitor.start()
+    await service_provider.google_drive_client.setup()
+    await service_provider.rabbitmq_broker.connect()
+    logger.info(f"Worker {index} started with pid {os.getpid()}")
+    metrics = asyncio.create_task(log_metrics(index, stop))
+    try:
+        await service_provider.rabbitmq_broker.consume(
+            service_provider.media_service.process_task,
+            service_provider.media_service.process_batch,
+            stop,
+            service_provider.media_service.handle_control,
+        )
+    finally:
+        metrics.cancel()
+        await service_provider.shutdown()
+    logger.info(f"Worker {index} stopped")
+
+
+def _run(index: int):
+    asyncio.run(serve(index))
+
+
+def _start(context, index: int) -> multiprocessing.Process:
+    process = context.Process(target=_run, args=(index,), name=f"worker-{index}")
+    process.start()
+    return process
+
+
+def main():
+    settings = get_settings()
+    processes = max(1, settings.WORKER_PROCESSES)
+    if processes > 1 and not settings.RENDER_THREADS:
+        # split the CPUs between processes instead of letting each claim all of them
+        os.environ["RENDER_THREADS"] = str(max(1, available_cpus() // processes))
+    if processes == 1:
+        _run(0)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    workers: dict[int, multiprocessing.Process] = {}
+    stopping = False
+
+    def _stop(signum, _):
+        nonlocal stopping
+        stopping = True
+        for process in workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    for index in range(processes):
+        workers[index] = _start(context, index)
+    while workers:
+        wait([process.sentinel for process in workers.values()])
+        for index, process in list(workers.items()):
+            if process.is_alive():
+                continue
+            del workers[index]
+            if stopping:
+                continue
+            logger.warning(f"Worker {index} exited with {process.exitcode}, restarting")
+            time.sleep(1)
+            if not stopping:
+                workers[index] = _start(context, index)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+
+from image_processor.broker import Broker
+
+logger = logging.getLogger(__name__)
+
+
+class ExchangeStub:
+    def __init__(self, name: str, fail: bool = False):
+        self.name = name
+        self.fail = fail
+        self.published = []
+
+    async def publish(self, message, routing_key: str):
+        if self.fail:
+            raise Exception("channel closed")
+        self.published.append((routing_key, message))
+
+
+class MessageStub:
+    def __init__(self, routing_key: str, headers: dict | None = None):
+        self.body = b"{}"
+        self.headers = headers
+        self.message_id = "m1"
+        self.priority = 3
+        self.routing_key = routing_key
+        self.acked = False
+        self.requeued = None
+
+    async def ack(self):
+        self.acked = True
+
+    async def reject(self, requeue: bool = False):
+        self.requeued = requeue
+
+
+def _broker(retries: int = 2, fail: bool = False) -> tuple[Broker, ExchangeStub]:
+    broker = Broker(logger)
+    broker._retry_exchanges = [
+        ExchangeStub(f"image_processor.retry.{10 * 2 ** i}s", fail) for i in range(retries)
+    ]
+    default_exchange = ExchangeStub("", fail)
+    broker._channel = SimpleNamespace(default_exchange=default_exchange)
+    return broker, default_exchange
+
+
+def test_retry_goes_to_the_next_delay_queue():
+    broker, default_exchange = _broker()
+    message = MessageStub("image_processor.p10", {"x-retries": 1, "x-death": [{}]})
+
+    asyncio.run(broker._retry(message, Exception("boom"), 1))
+
+    routing_key, republished = broker._retry_exchanges[1].published[0]
+    assert routing_key == "image_processor.p10"
+    assert republished.headers == {"x-retries": 2, "x-error": "boom"}
+    assert republished.priority == 3
+    assert message.acked
+    assert not default_exchange.published
+
+
+def test_retry_dead_letters_after_the_last_retry_or_when_asked():
+    broker, default_exchange = _broker()
+    exhausted = MessageStub("image_processor.p10")
+    invalid = MessageStub("image_processor.parts.p10")
+
+    async def run():
+        await broker._retry(exhausted, Exception("boom"), 2)
+        await broker._retry(invalid, Exception("bad payload"), 0, dead_letter=True)
+
+    asyncio.run(run())
+
+    assert [key for key, _ in default_exchange.published] == ["image_processor.dead"] * 2
+    assert default_exchange.published[1][1].headers == {
+        "x-error": "bad payload",
+        "x-source-queue": "image_processor.parts.p10",
+    }
+    assert exhausted.acked and invalid.acked
+    assert not any(exchange.published for exchange in broker._retry_exchanges)
+
+
+def test_retry_requeues_when_republishing_fails():
+    broker, _ = _broker(fail=True)
+    message = MessageStub("image_processor.p10")
+
+    asyncio.run(broker._retry(message, Exception("boom"), 0))
+
+    assert message.requeued is True
+    assert not message.acked
+
+
+def test_retry_moves_messages_of_legacy_queues_to_their_priority_queue():
+    broker, _ = _broker()
+    jobs = MessageStub("image_processor")
+    parts = MessageStub("image_processor.parts")
+
+    async def run():
+        await broker._retry(jobs, Exception("boom"), 0)
+        await broker._retry(parts, Exception("boom"), 0)
+
+    asyncio.run(run())
+
+    assert [key for key, _ in broker._retry_exchanges[0].published] == [
+        "image_processor.p10",
+        "image_processor.parts.p10",
+    ]
@@ -0,0 +1,42 @@
+from image_processor.core.constants import CHUNK_SIZE, FILE_CHUNK_SIZE
+from image_processor.google_clients.chunk_sizer import ChunkSizer
+
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def test_initial_size_is_aligned_and_clamped():
+    assert ChunkSizer(FILE_CHUNK_SIZE, CHUNK_SIZE, MAX_CHUNK_SIZE).next_size() == FILE_CHUNK_SIZE
+    assert ChunkSizer(CHUNK_SIZE + 1, CHUNK_SIZE, MAX_CHUNK_SIZE).next_size() == CHUNK_SIZE
+    assert ChunkSizer(1, 1, MAX_CHUNK_SIZE).next_size() == CHUNK_SIZE
+    assert ChunkSizer(10 * MAX_CHUNK_SIZE, CHUNK_SIZE, MAX_CHUNK_SIZE).next_size() == MAX_CHUNK_SIZE
+
+
+def test_size_follows_the_bandwidth_delay_product():
+    sizer = ChunkSizer(FILE_CHUNK_SIZE, CHUNK_SIZE, MAX_CHUNK_SIZE)
+    sizer.record_rtt(0.1)
+    # 1 MB in 0.1 s of transfer after the round-trip: 10 MB/s
+    sizer.record_chunk(1024 * 1024, 0.2)
+
+    # 10 MB/s * 0.1 s * 0.9 / 0.1, aligned down to 256 KB
+    expected = int(10 * 1024 * 1024 * 0.1 * 9)
+    assert sizer.next_size() == expected - expected % CHUNK_SIZE
+    assert sizer.next_size() % CHUNK_SIZE == 0
+
+
+def test_size_stays_within_bounds():
+    sizer = ChunkSizer(FILE_CHUNK_SIZE, FILE_CHUNK_SIZE, 2 * FILE_CHUNK_SIZE)
+    sizer.record_rtt(0.001)
+    sizer.record_chunk(CHUNK_SIZE, 1.0)
+    assert sizer.next_size() == FILE_CHUNK_SIZE
+
+    sizer = ChunkSizer(FILE_CHUNK_SIZE, CHUNK_SIZE, 2 * FILE_CHUNK_SIZE)
+    sizer.record_rtt(1.0)
+    sizer.record_chunk(100 * 1024 * 1024, 1.1)
+    assert sizer.next_size() == 2 * FILE_CHUNK_SIZE
+
+
+def test_size_is_kept_until_both_rtt_and_throughput_are_known():
+    sizer = ChunkSizer(FILE_CHUNK_SIZE, CHUNK_SIZE, MAX_CHUNK_SIZE)
+    sizer.record_chunk(1024 * 1024, 0.01)
+
+    assert sizer.next_size() == FILE_CHUNK_SIZE
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import os
+
+from image_processor.core.disk_cache import DiskCache
+
+logger = logging.getLogger(__name__)
+
+
+def _fill(content: bytes, calls: list | None = None, delay: float = 0):
+    async def fill(path: str, _) -> dict:
+        if calls is not None:
+            calls.append(path)
+        await asyncio.sleep(delay)
+        with open(path, "wb") as f:
+            f.write(content)
+        return {"length": len(content)}
+
+    return fill
+
+
+def test_concurrent_acquires_fill_once(tmp_path):
+    cache = DiskCache("test", str(tmp_path), 1000, logger)
+    calls = []
+
+    async def run():
+        return await asyncio.gather(
+            *(cache.acquire("key", _fill(b"x" * 10, calls, delay=0.05)) for _ in range(5))
+        )
+
+    entries = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert all(entry is entries[0] for entry in entries)
+    assert entries[0].refs == 5
+    assert cache.stats()["coalesced"] == 4
+
+
+def test_unused_entries_are_evicted_over_budget(tmp_path):
+    cache = DiskCache("test", str(tmp_path), 100, logger)
+
+    async def run():
+        first = await cache.acquire("first", _fill(b"x" * 60))
+        cache.release(first)
+        pinned = await cache.acquire("pinned", _fill(b"x" * 60))
+        last = await cache.acquire("last", _fill(b"x" * 60))
+        return first, pinned, last
+
+    first, pinned, last = asyncio.run(run())
+
+    assert not os.path.exists(first.path)
+    # entries in use outlive the budget
+    assert os.path.exists(pinned.path) and os.path.exists(last.path)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_processes_use_separate_slots(tmp_path):
+    first = DiskCache("test", str(tmp_path), 1000, logger)
+    second = DiskCache("test", str(tmp_path), 1000, logger)
+
+    async def run():
+        return await first.acquire("key", _fill(b"x" * 10))
+
+    entry = asyncio.run(run())
+
+    assert first.stats()["slot"] == "slot-0"
+    assert second.stats()["slot"] == "slot-1"
+    assert os.path.exists(entry.path)
+    assert DiskCache.read_meta(str(tmp_path), "key") == {"length": 10}
+    assert DiskCache.read_meta(str(tmp_path), "missing") is None
+
+
+def test_released_slot_is_taken_over_with_its_entries(tmp_path):
+    cache = DiskCache("test", str(tmp_path), 1000, logger)
+
+    async def run():
+        return await cache.acquire("key", _fill(b"x" * 10))
+
+    entry = asyncio.run(run())
+    cache._slot_lock.close()
+    restarted = DiskCache("test", str(tmp_path), 1000, logger)
+
+    assert restarted.stats()["slot"] == "slot-0"
+    assert restarted.stats()["entries"] == 1
+    assert os.path.exists(entry.path)
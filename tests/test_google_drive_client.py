@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import os
+import re
+import uuid
+from contextlib import asynccontextmanager
+
+import aiohttp
+from aiohttp import web
+from google.oauth2.credentials import Credentials
+
+from image_processor.config import get_settings
+from image_processor.core.constants import CHUNK_SIZE
+from image_processor.google_clients.chunk_sizer import ChunkSizer
+from image_processor.google_clients.google_drive_client import GoogleDriveClient
+
+_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\S+)")
+_STATUS = re.compile(r"bytes \*/(\S+)")
+
+
+class DriveStub:
+    """Resumable upload endpoints behaving like Drive's"""
+
+    def __init__(self):
+        self.sessions: dict[str, dict] = {}
+        self.files: dict[str, bytes] = {}
+        self.content_ranges: list[str] = []
+        # bytes of the next chunk stored before it fails with 503
+        self.fail_after: int | None = None
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/upload/drive/v3/files", self._start)
+        app.router.add_put("/session/{sid}", self._put)
+        app.router.add_delete("/session/{sid}", self._delete)
+        return app
+
+    async def _start(self, request: web.Request) -> web.Response:
+        metadata = await request.json()
+        sid = uuid.uuid4().hex
+        self.sessions[sid] = {"name": metadata["name"], "data": bytearray()}
+        return web.Response(headers={"Location": f"http://{request.host}/session/{sid}"})
+
+    async def _delete(self, request: web.Request) -> web.Response:
+        self.sessions.pop(request.match_info["sid"], None)
+        return web.Response(status=204)
+
+    async def _put(self, request: web.Request) -> web.Response:
+        sid = request.match_info["sid"]
+        session = self.sessions.get(sid)
+        if session is None:
+            return web.Response(status=404)
+        body = await request.read()
+        content_range = request.headers["Content-Range"]
+        self.content_ranges.append(content_range)
+        data = session["data"]
+
+        status = _STATUS.fullmatch(content_range)
+        if status:
+            if status.group(1) != "*" and int(status.group(1)) == len(data):
+                return self._finish(sid)
+            return self._incomplete(data)
+
+        start, end, total = _RANGE.fullmatch(content_range).groups()
+        assert int(start) == len(data)
+        assert int(end) - int(start) + 1 == len(body)
+        if total == "*" or int(end) + 1 < int(total):
+            # every chunk but the last one is a multiple of 256 KB
+            assert len(body) % CHUNK_SIZE == 0
+        if self.fail_after is not None:
+            data += body[: self.fail_after]
+            self.fail_after = None
+            return web.Response(status=503)
+        data += body
+        if total != "*" and len(data) == int(total):
+            return self._finish(sid)
+        return self._incomplete(data)
+
+    @staticmethod
+    def _incomplete(data: bytearray) -> web.Response:
+        headers = {"Range": f"bytes=0-{len(data) - 1}"} if data else {}
+        return web.Response(status=308, headers=headers)
+
+    def _finish(self, sid: str) -> web.Response:
+        session = self.sessions.pop(sid)
+        file_id = uuid.uuid4().hex
+        self.files[file_id] = bytes(session["data"])
+        return web.json_response({"id": file_id, "name": session["name"]})
+
+
+@asynccontextmanager
+async def drive_client(stub: DriveStub, chunk_size: int = CHUNK_SIZE):
+    runner = web.AppRunner(stub.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    port = runner.addresses[0][1]
+    client = GoogleDriveClient("token.json", logging.getLogger(__name__), None)
+    client.UPLOAD_API = f"http://127.0.0.1:{port}/upload/drive/v3"
+    client.MAX_BACKOFF = 0
+    client._chunk_sizer = ChunkSizer(chunk_size, chunk_size, chunk_size)
+    client._GoogleDriveClient__tokens._creds = Credentials(token="token")
+    try:
+        async with aiohttp.ClientSession() as session:
+            client._GoogleDriveClient__session = session
+            yield client
+    finally:
+        await runner.cleanup()
+
+
+def _stream(data: bytes) -> asyncio.StreamReader:
+    stream = asyncio.StreamReader()
+    stream.feed_data(data)
+    stream.feed_eof()
+    return stream
+
+
+def test_upload_stream_sends_unknown_total_until_the_last_chunk():
+    stub = DriveStub()
+    data = os.urandom(2 * CHUNK_SIZE + 1000)
+
+    async def run():
+        async with drive_client(stub) as client:
+            return await client.upload_stream(_stream(data), "part.mp4")
+
+    file_id = asyncio.run(run())
+
+    assert stub.files[file_id] == data
+    assert stub.content_ranges == [
+        "bytes */*",
+        f"bytes 0-{CHUNK_SIZE - 1}/*",
+        f"bytes {CHUNK_SIZE}-{2 * CHUNK_SIZE - 1}/*",
+        f"bytes {2 * CHUNK_SIZE}-{len(data) - 1}/{len(data)}",
+    ]
+
+
+def test_upload_stream_of_whole_chunks_finalizes_with_the_total():
+    stub = DriveStub()
+    data = os.urandom(2 * CHUNK_SIZE)
+
+    async def run():
+        async with drive_client(stub) as client:
+            return await client.upload_stream(_stream(data), "part.mp4")
+
+    file_id = asyncio.run(run())
+
+    assert stub.files[file_id] == data
+    assert stub.content_ranges[-1] == f"bytes */{len(data)}"
+
+
+def test_upload_stream_is_cancelled_when_the_producer_fails():
+    stub = DriveStub()
+
+    async def failed():
+        raise Exception("ffmpeg failed")
+
+    async def run():
+        async with drive_client(stub) as client:
+            await client.upload_stream(
+                _stream(os.urandom(CHUNK_SIZE + 10)), "part.mp4", before_finalize=failed
+            )
+
+    try:
+        asyncio.run(run())
+    except Exception as e:
+        assert str(e) == "ffmpeg failed"
+    else:
+        raise AssertionError("upload_stream did not fail")
+    assert not stub.sessions
+    assert not stub.files
+
+
+def test_upload_file_resumes_from_the_acknowledged_range(tmp_path):
+    stub = DriveStub()
+    stub.fail_after = CHUNK_SIZE
+    data = os.urandom(3 * CHUNK_SIZE + 1000)
+    path = tmp_path / "part.mp4"
+    path.write_bytes(data)
+
+    async def run():
+        async with drive_client(stub, chunk_size=2 * CHUNK_SIZE) as client:
+            return await client.upload_file(str(path), "part.mp4")
+
+    file_id = asyncio.run(run())
+
+    assert stub.files[file_id] == data
+    assert stub.content_ranges == [
+        f"bytes */{len(data)}",
+        f"bytes 0-{2 * CHUNK_SIZE - 1}/{len(data)}",
+        # 503 after the first 256 KB were stored
+        f"bytes */{len(data)}",
+        f"bytes {CHUNK_SIZE}-{2 * CHUNK_SIZE - 1}/{len(data)}",
+        f"bytes {2 * CHUNK_SIZE}-{len(data) - 1}/{len(data)}",
+    ]
+
+
+def test_query_upload_status_parses_the_range_header():
+    stub = DriveStub()
+
+    async def run():
+        async with drive_client(stub) as client:
+            upload_url = await client.upload_file_in_stream("part.mp4")
+            empty = await client.query_upload_status(upload_url, 4 * CHUNK_SIZE)
+            stub.sessions[upload_url.rsplit("/", 1)[1]]["data"] += b"x" * CHUNK_SIZE
+            stored = await client.query_upload_status(upload_url, 4 * CHUNK_SIZE)
+            return empty, stored
+
+    empty, stored = asyncio.run(run())
+
+    assert empty == (0, None)
+    assert stored == (CHUNK_SIZE, None)
+
+
+def test_failed_upload_without_a_session_key_is_aborted(tmp_path):
+    stub = DriveStub()
+    path = tmp_path / "part.mp4"
+    path.write_bytes(os.urandom(CHUNK_SIZE + 10))
+
+    async def run():
+        async with drive_client(stub) as client:
+            # every retry of the chunk fails as well
+            client._send_chunk = _failing_send
+            try:
+                await client.upload_file(str(path), "part.mp4")
+            except Exception as e:
+                return e
+
+    assert str(asyncio.run(run())) == "Drive unavailable"
+    assert not stub.sessions
+    assert not os.listdir(get_settings().UPLOAD_SESSIONS_DIR)
+
+
+async def _failing_send(*args):
+    raise Exception("Drive unavailable")
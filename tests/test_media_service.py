@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import random
+
+import pytest
+
+from image_processor.media.schema import CreateMediaSchema, RenderBatchSchema
+from image_processor.media.service import MediaService
+from image_processor.tasks.store import TaskStore
+
+logger = logging.getLogger(__name__)
+
+
+def _payload(**fields) -> CreateMediaSchema:
+    return CreateMediaSchema(
+        task_name="job",
+        video_blocks={
+            block: [f"https://example.com/{block}{i}.mp4" for i in range(4)]
+            for block in ("a", "b", "c")
+        },
+        audio_blocks={"music": [f"https://example.com/m{i}.mp3" for i in range(3)]},
+        text_to_speech=[{"text": f"line {i}", "voice": "voice"} for i in range(3)],
+        **fields,
+    )
+
+
+def _plan(payload: CreateMediaSchema, outputs: int) -> list:
+    rng = random.Random(payload.seed)
+    return list(
+        MediaService._plan_parts(payload, payload.ordered_video_blocks(), outputs, rng)
+    )
+
+
+def test_plan_parts_depends_only_on_the_seed():
+    plan = _plan(_payload(seed=7), 20)
+
+    assert _plan(_payload(seed=7), 20) == plan
+    assert _plan(_payload(seed=8), 20) != plan
+    assert [part.index for part in plan] == list(range(20))
+    # every part is a different combination of clips
+    assert len({tuple(map(str, part.video_urls)) for part in plan}) == 20
+
+
+class BrokerStub:
+    def __init__(self):
+        self.events = []
+
+    async def publish_event(self, event: dict):
+        self.events.append(event)
+
+
+class DriveStub:
+    async def discard_upload(self, key: str):
+        pass
+
+
+def _service(tmp_path, renders: list, fail: set[int] = frozenset()):
+    """A service whose renders upload every part except those in fail"""
+    store = TaskStore(str(tmp_path), 3600, logger)
+    broker = BrokerStub()
+    service = MediaService(
+        DriveStub(), broker, logger, None, None, None, None, store, None, None
+    )
+
+    async def _render_batch(batch, progress, on_uploaded):
+        renders.append([part.index for part in batch.parts])
+        results = {}
+        for part in batch.parts:
+            if part.index in fail:
+                results[part.index] = Exception("upload failed")
+                continue
+            await on_uploaded(part.index, f"file-{part.index}")
+            results[part.index] = f"file-{part.index}"
+        return results
+
+    service._render_batch = _render_batch
+    return service, store, broker
+
+
+def _batch(outputs: int) -> RenderBatchSchema:
+    payload = _payload(seed=1)
+    return RenderBatchSchema(task_id="t1", task_name="job", parts=_plan(payload, outputs))
+
+
+def test_retried_batch_skips_uploaded_parts(tmp_path):
+    renders, fail = [], {1}
+    service, store, broker = _service(tmp_path, renders, fail)
+
+    async def run():
+        await store.create("t1", "job", 0, status=TaskStore.QUEUED)
+        await store.start("t1", total=3)
+        with pytest.raises(Exception, match="1 part"):
+            await service.process_batch(_batch(3), last_attempt=False)
+        checkpointed = await store.get("t1")
+        fail.clear()
+        await service.process_batch(_batch(3), last_attempt=False)
+        # a redelivery of a finished batch renders nothing
+        await service.process_batch(_batch(3), last_attempt=False)
+        return checkpointed, await store.get("t1")
+
+    checkpointed, record = asyncio.run(run())
+
+    assert sorted(checkpointed["parts"]) == ["0", "2"]
+    assert renders == [[0, 1, 2], [1]]
+    assert record["status"] == TaskStore.FINISHED
+    assert [event["file_ids"] for event in broker.events] == [["file-0", "file-1", "file-2"]]
@@ -0,0 +1,23 @@
+import time
+from email.utils import formatdate
+
+from image_processor.core.rate_limiter import parse_retry_after
+
+
+def test_parse_retry_after_seconds():
+    assert parse_retry_after("12", 5) == 12
+    assert parse_retry_after("1.5", 5) == 1.5
+    assert parse_retry_after("-3", 5) == 0
+
+
+def test_parse_retry_after_http_date():
+    delay = parse_retry_after(formatdate(time.time() + 30, usegmt=True), 5)
+
+    assert 28 <= delay <= 30
+    assert parse_retry_after(formatdate(time.time() - 30, usegmt=True), 5) == 0
+
+
+def test_parse_retry_after_falls_back_to_default():
+    assert parse_retry_after(None, 5) == 5
+    assert parse_retry_after("", 5) == 5
+    assert parse_retry_after("soon", 5) == 5
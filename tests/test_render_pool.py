@@ -0,0 +1,70 @@
+import asyncio
+import logging
+
+from image_processor.media.render_pool import RenderPool
+
+logger = logging.getLogger(__name__)
+
+
+async def _job(pool: RenderPool, name: str, threads: int, order: list, done: asyncio.Event):
+    async with pool._reserve(threads):
+        order.append(name)
+        await done.wait()
+
+
+async def _settle():
+    """Let woken jobs run until they block again"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_reserve_does_not_let_narrow_jobs_overtake_a_wide_one():
+    async def run():
+        pool = RenderPool(logger, threads=2)
+        order = []
+        first, rest = asyncio.Event(), asyncio.Event()
+        tasks = [asyncio.create_task(_job(pool, "first", 1, order, first))]
+        await _settle()
+        for name, threads in (("wide", 2), ("narrow", 1)):
+            tasks.append(asyncio.create_task(_job(pool, name, threads, order, rest)))
+            await _settle()
+        # a thread is free, but the narrow job queues behind the wide one
+        waiting = pool.stats()["waiting"]
+        first.set()
+        await _settle()
+        started = list(order)
+        rest.set()
+        await asyncio.gather(*tasks)
+        return waiting, started, order, pool.stats()
+
+    waiting, started, order, stats = asyncio.run(run())
+
+    assert waiting == 2
+    assert started == ["first", "wide"]
+    assert order == ["first", "wide", "narrow"]
+    assert stats["busy"] == 0 and stats["waiting"] == 0
+
+
+def test_urgent_renders_are_served_before_queued_ones():
+    async def run():
+        pool = RenderPool(logger, threads=1)
+        order = []
+        first, rest = asyncio.Event(), asyncio.Event()
+        tasks = [asyncio.create_task(_job(pool, "first", 1, order, first))]
+        await _settle()
+        for name in ("queued-0", "queued-1"):
+            tasks.append(asyncio.create_task(_job(pool, name, 1, order, rest)))
+            await _settle()
+        with pool.urgent():
+            tasks.append(asyncio.create_task(_job(pool, "preview", 1, order, rest)))
+        await _settle()
+        stats = pool.stats()
+        first.set()
+        rest.set()
+        await asyncio.gather(*tasks)
+        return stats, order
+
+    stats, order = asyncio.run(run())
+
+    assert stats["waiting"] == 3 and stats["urgent"] == 1
+    assert order == ["first", "preview", "queued-0", "queued-1"]
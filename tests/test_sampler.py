@@ -0,0 +1,68 @@
+import itertools
+import random
+from collections import Counter
+
+from image_processor.media.sampler import (
+    combination_at,
+    combination_count,
+    sample_combinations,
+)
+
+BLOCKS = [["a1", "a2"], ["b1"], ["c1", "c2", "c3"]]
+
+
+def test_combination_at_enumerates_the_product_in_order():
+    product = list(itertools.product(*BLOCKS))
+
+    assert combination_count(BLOCKS) == len(product)
+    assert [combination_at(BLOCKS, i) for i in range(len(product))] == product
+
+
+def test_sample_combinations_are_distinct():
+    sampled = list(sample_combinations(BLOCKS, 4, random.Random(1)))
+
+    assert len(sampled) == 4
+    assert len(set(sampled)) == 4
+    assert set(sampled) <= set(itertools.product(*BLOCKS))
+
+
+def test_sample_combinations_returns_all_when_count_exceeds_total():
+    sampled = list(sample_combinations(BLOCKS, 100, random.Random(1)))
+
+    assert sorted(sampled) == sorted(itertools.product(*BLOCKS))
+
+
+def test_sample_combinations_depend_only_on_the_seed():
+    first = list(sample_combinations(BLOCKS, 3, random.Random(7)))
+
+    assert list(sample_combinations(BLOCKS, 3, random.Random(7))) == first
+
+
+def test_sample_combinations_are_uniform():
+    rng = random.Random(3)
+    counts = Counter(
+        combination
+        for _ in range(6000)
+        for combination in sample_combinations(BLOCKS, 3, rng)
+    )
+
+    # every one of the 6 combinations is expected 3000 times
+    assert len(counts) == 6
+    assert all(2700 < count < 3300 for count in counts.values())
+
+
+def test_sample_combinations_do_not_build_a_huge_product():
+    blocks = [[str(i) for i in range(1000)]] * 5
+    sampled = list(sample_combinations(blocks, 10, random.Random(1)))
+
+    assert len(set(sampled)) == 10
+
+
+def test_sample_combinations_beyond_the_index_range():
+    # 100 ** 10 combinations, more than fit a C ssize_t
+    blocks = [[str(i) for i in range(100)]] * 10
+    sampled = list(sample_combinations(blocks, 5, random.Random(1)))
+
+    assert combination_count(blocks) > 2**63
+    assert len(set(sampled)) == 5
+    assert list(sample_combinations(blocks, 5, random.Random(1))) == sampled
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+
+from image_processor.tasks.store import TaskStore
+
+logger = logging.getLogger(__name__)
+
+
+def test_create_returns_the_existing_record(tmp_path):
+    store = TaskStore(str(tmp_path), 3600, logger)
+
+    async def run():
+        created = await store.create("t1", "job", 2)
+        redelivered = await store.create("t1", "other", 5)
+        return created, redelivered
+
+    created, redelivered = asyncio.run(run())
+
+    assert redelivered == created
+    assert redelivered["task_name"] == "job"
+
+
+def test_complete_parts_finishes_the_task_once(tmp_path):
+    store = TaskStore(str(tmp_path), 3600, logger)
+
+    async def run():
+        await store.create("t1", "job", 2)
+        partial = await store.complete_parts("t1", {0: "file-0"})
+        finished = await store.complete_parts("t1", {1: Exception("failed")})
+        # a redelivered batch does not overwrite an upload
+        await store.complete_parts("t1", {0: Exception("failed")})
+        return partial, finished, await store.get("t1")
+
+    partial, finished, record = asyncio.run(run())
+
+    assert partial is None
+    assert finished["status"] == TaskStore.FINISHED
+    assert record["parts"]["0"] == {"file_id": "file-0", "error": None}
+    assert record["parts"]["1"] == {"file_id": None, "error": "failed"}
+
+
+def test_task_without_uploads_fails(tmp_path):
+    store = TaskStore(str(tmp_path), 3600, logger)
+
+    async def run():
+        await store.create("t1", "job", 1)
+        return await store.complete_parts("t1", {0: Exception("failed")})
+
+    assert asyncio.run(run())["status"] == TaskStore.FAILED
+
+
+def test_cancel_only_stops_live_tasks(tmp_path):
+    store = TaskStore(str(tmp_path), 3600, logger)
+
+    async def run():
+        await store.create("t1", "job", 1)
+        cancelled = await store.cancel("t1")
+        await store.create("t2", "job", 1)
+        await store.complete_parts("t2", {0: "file-0"})
+        return cancelled, await store.cancel("t2"), await store.cancel("missing")
+
+    cancelled, finished, missing = asyncio.run(run())
+
+    assert cancelled["status"] == TaskStore.CANCELLED
+    assert finished["status"] == TaskStore.FINISHED
+    assert missing is None
+
+
+def test_claim_attaches_to_the_task_of_a_key(tmp_path):
+    store = TaskStore(str(tmp_path), 3600, logger)
+
+    async def run():
+        first = await store.claim("key", 60, 60, "t1", "job", 1)
+        second = await store.claim("key", 60, 60, "t2", "job", 1)
+        await store.complete_parts("t1", {0: "file-0"})
+        reused = await store.claim("key", 60, 60, "t3", "job", 1)
+        expired = await store.claim("key", 60, 0, "t4", "job", 1)
+        return first, second, reused, expired
+
+    first, second, reused, expired = asyncio.run(run())
+
+    assert first[1] and first[0]["task_id"] == "t1"
+    assert not second[1] and second[0]["task_id"] == "t1"
+    assert not reused[1] and reused[0]["status"] == TaskStore.FINISHED
+    assert expired[1] and expired[0]["task_id"] == "t4"
+
+
+def test_backlog_counts_the_remaining_cost_of_live_tasks(tmp_path):
+    store = TaskStore(str(tmp_path), 3600, logger)
+
+    async def run():
+        await store.create("t1", "job", 4, cost=100.0, status=TaskStore.QUEUED)
+        await store.create("t2", "job", 2, cost=50.0)
+        backlogs = [await store.backlog(60)]
+        await store.complete_parts("t1", {0: "file-0"})
+        backlogs.append(await store.backlog(60))
+        await store.cancel("t2")
+        backlogs.append(await store.backlog(60))
+        await store.update("t1", status=TaskStore.FAILED)
+        backlogs.append(await store.backlog(60))
+        return backlogs
+
+    assert asyncio.run(run()) == [150.0, 125.0, 75.0, 0]
+
+
+def test_backlog_ignores_stale_tasks(tmp_path):
+    store = TaskStore(str(tmp_path), 3600, logger)
+
+    async def run():
+        await store.create("t1", "job", 1, cost=100.0)
+        await asyncio.sleep(0.01)
+        return await store.backlog(0.005), await store.backlog(60)
+
+    assert asyncio.run(run()) == (0, 100.0)
+
+
+def test_old_records_are_pruned_at_most_once_per_interval(tmp_path):
+    store = TaskStore(str(tmp_path), 0, logger)
+
+    async def run():
+        await store.create("t1", "job", 1)
+        await asyncio.sleep(0.01)
+        await store.create("t2", "job", 1)
+        return await store.get("t1")
+
+    # the first create pruned, the second one within the interval did not
+    assert asyncio.run(run()) is not None